@@ -1,27 +1,147 @@
+import io
 import os
+import re
+import csv
 import math
 import json
-import pytz
+import time
+import bisect
+import click
+import hashlib
+import queue
 import shlex
-import tzlocal
+import sqlite3
 import inspect
 import datetime
-import parsedatetime
-from collections import defaultdict
+import itertools
+import threading
+import contextlib
+import urllib.request
+from collections import defaultdict, OrderedDict
 from flask import Flask, request, Response
 from flask.ext.sqlalchemy import SQLAlchemy
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import make_transient_to_detached
 
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
     'DATABASE_URL', 'postgres:///predictionslocal')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Connection pool settings, per worker process.  Keep pool size + overflow
+# times the number of workers under the database's connection limit.
+for key, env in [('SQLALCHEMY_POOL_SIZE', 'DB_POOL_SIZE'),
+                 ('SQLALCHEMY_MAX_OVERFLOW', 'DB_MAX_OVERFLOW'),
+                 ('SQLALCHEMY_POOL_TIMEOUT', 'DB_POOL_TIMEOUT'),
+                 ('SQLALCHEMY_POOL_RECYCLE', 'DB_POOL_RECYCLE')]:
+    if env in os.environ:
+        app.config[key] = int(os.environ[env])
+# Acknowledge commands straight away and post the reply to Slack's
+# response_url from a background thread, to stay inside Slack's 3s timeout.
+app.config['DEFERRED_RESPONSES'] = os.environ.get('DEFERRED_RESPONSES') == '1'
+# Slack retries of a command within this many seconds are answered from the
+# first attempt's reply rather than run again.  Retries are matched by
+# trigger_id, or failing that by the same text from the same user and channel
+# within DEDUPE_WINDOW_SECONDS.
+app.config['DEDUPE_SECONDS'] = int(os.environ.get('DEDUPE_SECONDS', 300))
+app.config['DEDUPE_WINDOW_SECONDS'] = int(
+    os.environ.get('DEDUPE_WINDOW_SECONDS', 10))
+# Token-bucket rate limits, per user and per channel: up to *_RATE_BURST
+# commands at once, refilled at *_RATE_PER_MINUTE.  A rate of 0 turns that
+# limit off.  The buckets are kept per worker, or shared between workers in
+# Redis if RATE_LIMIT_REDIS_URL is set.
+for key, default in [('USER_RATE_PER_MINUTE', 30), ('USER_RATE_BURST', 10),
+                     ('CHANNEL_RATE_PER_MINUTE', 120),
+                     ('CHANNEL_RATE_BURST', 40)]:
+    app.config[key] = float(os.environ.get(key, default))
+app.config['RATE_LIMIT_REDIS_URL'] = os.environ.get('RATE_LIMIT_REDIS_URL')
+# Send read-only commands to this database, e.g. a replica, with a pool of
+# its own.  They may then not see writes made just before.
+app.config['READ_DATABASE_URL'] = os.environ.get('READ_DATABASE_URL')
+if app.config['READ_DATABASE_URL']:
+    app.config['SQLALCHEMY_BINDS'] = {'read': app.config['READ_DATABASE_URL']}
+# Log the SQL of any command that takes longer than this many milliseconds.
+app.config['SLOW_REQUEST_MS'] = (int(os.environ['SLOW_REQUEST_MS'])
+                                 if 'SLOW_REQUEST_MS' in os.environ else None)
 db = SQLAlchemy(app)
 
+# SQLite is for tests and local runs.  pysqlite begins transactions lazily
+# and commits before DDL, which breaks savepoints, so emit BEGIN ourselves.
+@db.event.listens_for(Engine, 'connect')
+def configure_sqlite(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.isolation_level = None
+        dbapi_connection.execute('PRAGMA foreign_keys = ON')
+
+@db.event.listens_for(Engine, 'begin')
+def begin_sqlite(connection):
+    if connection.dialect.name == 'sqlite':
+        connection.connection.execute('BEGIN')
+
 now = datetime.datetime.utcnow
 
+class LRUCache(object):
+    """A bounded, thread-safe cache shared by the requests in a worker.
+
+    Entries count as 1 towards max_size unless weigh is given, in which case
+    weigh(value) is used, e.g. to bound memory rather than entries.
+    """
+
+    def __init__(self, max_size, weigh=None):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._weigh = weigh or (lambda value: 1)
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, _ = self._items[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        weight = self._weigh(value)
+        if weight > self.max_size:
+            return
+        with self._lock:
+            if key in self._items:
+                self.size -= self._items.pop(key)[1]
+            self._items[key] = (value, weight)
+            self.size += weight
+            while self.size > self.max_size:
+                self.size -= self._items.popitem(last=False)[1][1]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __len__(self):
+        return len(self._items)
+
 class User(db.Model):
     user_id = db.Column(db.Integer, primary_key=True)
     slack_id = db.Column(db.UnicodeText, unique=True, nullable=False)
+    # Running totals over the score ledger, kept up to date by resolve and
+    # cancel so the leaderboard doesn't have to add up every contract.
+    score = db.Column(db.Float, nullable=False, default=0, server_default='0')
+    scored_contracts = db.Column(db.Integer, nullable=False, default=0,
+                                 server_default='0')
 
     def __init__(self, slack_id):
         self.slack_id = slack_id
@@ -36,11 +156,20 @@ class Contract(db.Model):
     user = db.relationship('User')
     user_id = db.Column(db.Integer, db.ForeignKey('user.user_id'),
                         nullable=False)
-    when_closes = db.Column(db.DateTime, nullable=False)
+    when_closes = db.Column(db.DateTime, nullable=False, index=True)
     when_created = db.Column(db.DateTime, nullable=False, default=now)
-    resolution = db.Column(db.Boolean, nullable=True)
+    resolution = db.Column(db.Boolean, nullable=True, index=True)
     when_resolved = db.Column(db.DateTime, nullable=True)
-    when_cancelled = db.Column(db.DateTime, nullable=True)
+    when_cancelled = db.Column(db.DateTime, nullable=True, index=True)
+    # The latest prediction, kept up to date by predict so that listing
+    # current odds doesn't need to scan predictions.
+    last_value = db.Column(db.Float, nullable=True)
+    when_last_predicted = db.Column(db.DateTime, nullable=True)
+    prediction_count = db.Column(db.Integer, nullable=False, default=0,
+                                 server_default='0')
+    # Bumped by every change that affects what show prints.
+    version = db.Column(db.Integer, nullable=False, default=0,
+                        server_default='0')
 
     def __init__(self, name, terms, user_id, when_closes):
         self.name = name
@@ -51,7 +180,40 @@ class Contract(db.Model):
     def __repr__(self):
         return '<Contract %s>' % self.name
 
+def active_filters():
+    return [Contract.resolution == None, Contract.when_cancelled == None]
+
+def resolved_filters():
+    return [Contract.resolution != None, Contract.when_cancelled == None]
+
+def cancelled_filters():
+    return [Contract.when_cancelled != None]
+
+# Partial indexes for the list commands, which page through names by status.
+for index_name, filters in [('ix_contract_active_name', active_filters()),
+                            ('ix_contract_resolved_name', resolved_filters()),
+                            ('ix_contract_cancelled_name',
+                             cancelled_filters())]:
+    db.Index(index_name, Contract.name, postgresql_where=db.and_(*filters),
+             sqlite_where=db.and_(*filters))
+
+# Postgres searches contracts with a full-text index on name and terms.
+# Other databases use the in-memory SearchIndex instead.
+db.event.listen(Contract.__table__, 'after_create', db.DDL(
+    "CREATE INDEX ix_contract_search ON contract USING gin "
+    "(to_tsvector('simple', name || ' ' || terms))").execute_if(
+        dialect='postgresql'))
+
 class Prediction(db.Model):
+    __table_args__ = (
+        # show and scoring read a contract's predictions in time order.
+        db.Index('ix_prediction_contract_id_when_created',
+                 'contract_id', 'when_created'),
+        # mine reads a user's latest prediction on each contract.
+        db.Index('ix_prediction_user_id_contract_id_when_created',
+                 'user_id', 'contract_id', 'when_created'),
+    )
+
     prediction_id = db.Column(db.Integer, primary_key=True)
     value = db.Column(db.Float, nullable=False)
     user = db.relationship('User')
@@ -67,27 +229,103 @@ class Prediction(db.Model):
         self.user_id = user_id
         self.contract_id = contract_id
 
+class Score(db.Model):
+    contract = db.relationship('Contract')
+    contract_id = db.Column(
+        db.Integer, db.ForeignKey('contract.contract_id'), primary_key=True)
+    user = db.relationship('User')
+    user_id = db.Column(
+        db.Integer, db.ForeignKey('user.user_id'), primary_key=True)
+    points = db.Column(db.Float, nullable=False)
+    # Copied from the contract so windowed leaderboards only touch this table.
+    when_resolved = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __init__(self, contract_id, user_id, points, when_resolved):
+        self.contract_id = contract_id
+        self.user_id = user_id
+        self.points = points
+        self.when_resolved = when_resolved
+
+    def __repr__(self):
+        return '<Score %s %s %.2f>' % (self.contract_id, self.user_id,
+                                       self.points)
+
+class SchemaVersion(db.Model):
+    version = db.Column(db.Integer, primary_key=True)
+    when_applied = db.Column(db.DateTime, nullable=False, default=now)
+
+    def __init__(self, version):
+        self.version = version
+
+    def __repr__(self):
+        return '<SchemaVersion %s>' % self.version
+
+# Schema changes for existing databases, applied in order by migrate().  Each
+# one gets a connection inside a transaction.  Keep the SQL in them frozen:
+# the models above describe the latest schema, not the one a migration sees.
+migrations = []
+def migration(fn):
+    migrations.append(fn)
+    return fn
+
+# Every command takes these before the arguments typed in Slack.
+INTERNAL_ARGS = ['session', 'user']
+
+class CommandSpec(object):
+    """What handle_request needs to know about a command, worked out once."""
+
+    def __init__(self, fn, read_only, usage=None):
+        parameters = [p for p in inspect.signature(
+            fn).parameters.values()][len(INTERNAL_ARGS):]
+        self.fn = fn
+        self.name = fn.__name__
+        self.args = [p.name for p in parameters
+                     if p.kind != inspect.Parameter.VAR_POSITIONAL]
+        self.min_args = len([p for p in parameters
+                             if p.default is inspect.Parameter.empty and
+                             p.kind != inspect.Parameter.VAR_POSITIONAL])
+        self.max_args = len(self.args)
+        if len(self.args) < len(parameters):
+            self.max_args = float('inf')
+        if usage is None:
+            usage = ' '.join(
+                ('<%s>' if i < self.min_args else '[<%s>]') % arg
+                for i, arg in enumerate(self.args))
+        self.usage = 'usage is %s %s' % (self.name, usage)
+        self.read_only = read_only
+
+    def __repr__(self):
+        return '<CommandSpec %s>' % self.name
+
 commands = {}
-def command(fn):
-    commands[fn.__name__] = fn
+def command(fn=None, read_only=False, usage=None):
+    """Registers a command.  usage replaces the generated argument list."""
+    if fn is None:
+        return lambda fn: command(fn, read_only=read_only, usage=usage)
+    commands[fn.__name__] = CommandSpec(fn, read_only, usage)
     return fn
 
-@command
+@command(read_only=True)
 def help(session, user_name):
     return """\
-/predict list
-/predict show <contract-name>
+/predict list [after <contract-name>]
+/predict mine
+/predict search <words> ...
+/predict show <contract-name> [summary|full]
 /predict create <contract-name> <contract-terms> <when-closes> <house-odds>
 /predict <contract-name> <percentage>
+/predict batch <contract-name>=<percentage> ...
 /predict resolve <contract-name> <true|false>
 /predict more_help"""
 
-@command
+@command(read_only=True)
 def more_help(session, user_name):
     return """\
 /predict cancel <contract-name>
-/predict list_resolved
-/predict list_cancelled"""
+/predict list_resolved [after <contract-name>]
+/predict list_cancelled [after <contract-name>]
+/predict leaderboard [<days>]
+/predict calibration [<user-name>|team]"""
 
 class PredictionsError(Exception):
     pass
@@ -114,44 +352,260 @@ def get_contract_or_raise(session, contract_name):
     contract = session.query(Contract).filter(
         Contract.name == contract_name).one_or_none()
     if not contract:
-         raise PredictionsError('unknown contract %s' % contract_name)
+        suggestions = [name for name, _ in search_contracts(
+            session, contract_name, SUGGESTIONS)]
+        if suggestions:
+            raise PredictionsError('unknown contract %s (did you mean %s?)' % (
+                contract_name, ', '.join(suggestions)))
+        raise PredictionsError('unknown contract %s' % contract_name)
     return contract
 
-@command
-def list(session, user):
-    r = []
-    for contract in session.query(Contract).filter(
-            Contract.resolution == None,
-            Contract.when_cancelled == None):
-        r.append(contract.name)
-    if not r:
-        return 'no active contracts'
-    return '\n'.join(r)
+def compute_scores(session, contract):
+    """Scores a resolved contract in one pass over its predictions.
 
-@command
-def list_cancelled(session, user):
-    r = []
-    for contract in session.query(Contract).filter(
-            Contract.when_cancelled != None):
-        r.append(contract.name)
-    if not r:
-        return 'no cancelled contracts'
-    return '\n'.join(r)
+    Returns a dict of user_id -> points.
+    """
+    previous = None
+    seen_non_house = False
+    scores = defaultdict(float)
+    for user_id, value in session.query(
+            Prediction.user_id, Prediction.value).filter(
+                Prediction.contract_id == contract.contract_id).order_by(
+                    Prediction.when_created, Prediction.prediction_id):
+        if user_id != contract.user_id:
+            # You don't get points for creating a contract and then betting
+            # on it yourself before anyone else does.  Just treat those as
+            # house odds.
+            seen_non_house = True
 
-@command
-def list_resolved(session, user):
-    r = []
-    for contract in session.query(Contract).filter(
-            Contract.resolution != None,
-            Contract.when_cancelled == None):
-        r.append(contract.name)
-    if not r:
-        return 'no resolved contracts'
-    return '\n'.join(r)
+        if previous is not None and seen_non_house:
+            if contract.resolution:
+                ratio = value / previous
+            else:
+                ratio = (1-value) / (1-previous)
+            scores[user_id] += 100*math.log(ratio)
+        previous = value
+    return scores
 
-@command
-def show(session, user, contract_name):
+def add_to_totals(session, user_id, points, contracts):
+    session.query(User).filter(User.user_id == user_id).update({
+        User.score: User.score + points,
+        User.scored_contracts: User.scored_contracts + contracts})
+
+def record_scores(session, contract):
+    for user_id, points in compute_scores(session, contract).items():
+        session.add(Score(contract_id=contract.contract_id, user_id=user_id,
+                          points=points,
+                          when_resolved=contract.when_resolved))
+        add_to_totals(session, user_id, points, 1)
+
+def clear_scores(session, contract):
+    for score in session.query(Score).filter(
+            Score.contract_id == contract.contract_id):
+        add_to_totals(session, score.user_id, -score.points, -1)
+    session.query(Score).filter(
+        Score.contract_id == contract.contract_id).delete()
+
+def rescore_all(session):
+    """Rebuilds the score ledger from scratch, e.g. after a backfill."""
+    session.query(Score).delete()
+    session.query(User).update({User.score: 0, User.scored_contracts: 0})
+    # Only the columns scoring needs.
+    for contract in session.query(
+            Contract.contract_id, Contract.user_id, Contract.resolution,
+            Contract.when_resolved).filter(*resolved_filters()):
+        record_scores(session, contract)
+
+# Page size for the list commands.  Slack cuts off long messages.
+PAGE_SIZE = 50
+
+def list_page(session, command_name, cursor, filters, empty_message,
+              with_odds=False):
+    """One page of contract names, in name order, after an optional cursor.
+
+    Only the needed columns are selected, and each status has a partial index
+    on name, so a page costs the same however many contracts there are.
+    """
+    if cursor and (len(cursor) != 2 or cursor[0] != 'after'):
+        raise PredictionsError(commands[command_name].usage)
+
+    query = session.query(Contract.name, Contract.last_value,
+                          Contract.prediction_count).filter(*filters)
+    if cursor:
+        query = query.filter(Contract.name > cursor[1])
+    rows = query.order_by(Contract.name).limit(PAGE_SIZE + 1).all()
+    if not rows:
+        return empty_message
+
+    more = ''
+    if len(rows) > PAGE_SIZE:
+        rows = rows[:PAGE_SIZE]
+        more = '\n(more: /predict %s after %s)' % (
+            command_name, shlex.quote(rows[-1].name))
+    if not with_odds:
+        return '\n'.join(row.name for row in rows) + more
+    # Contracts left without predictions by migration have no last_value.
+    return '\n'.join('%s   no predictions' % row.name
+                     if row.last_value is None else
+                     '%s   %.2f%% (%d prediction%s)' % (
+                         row.name, row.last_value*100, row.prediction_count,
+                         '' if row.prediction_count == 1 else 's')
+                     for row in rows) + more
+
+@command(read_only=True, usage='[after <contract-name>]')
+def list(session, user, *cursor):
+    return list_page(session, 'list', cursor, active_filters(),
+                     'no active contracts', with_odds=True)
+
+@command(read_only=True, usage='[after <contract-name>]')
+def list_cancelled(session, user, *cursor):
+    return list_page(session, 'list_cancelled', cursor, cancelled_filters(),
+                     'no cancelled contracts')
+
+@command(read_only=True, usage='[after <contract-name>]')
+def list_resolved(session, user, *cursor):
+    return list_page(session, 'list_resolved', cursor, resolved_filters(),
+                     'no resolved contracts')
+
+def bump_version(contract):
+    contract.version = Contract.version + 1
+
+def render_show(session, contract):
+    """The parts of show's output that only change with contract.version.
+
+    Returns (predictions, scoring), where predictions is a list of
+    (line, when_created) so that the relative times can be filled in later.
+    """
+    # Fetch the user names in the same query rather than lazy-loading
+    # prediction.user once per row.
+    predictions = [
+        ('%.2f%%   %s' % (value*100, slack_id), when_created)
+        for value, slack_id, when_created in session.query(
+            Prediction.value, User.slack_id, Prediction.when_created).join(
+                User, User.user_id == Prediction.user_id).filter(
+                    Prediction.contract_id == contract.contract_id).order_by(
+                        Prediction.when_created, Prediction.prediction_id)]
+
+    return predictions, render_show_scoring(session, contract)
+
+def render_show_scoring(session, contract):
+    # The ledger only has rows for resolved, non-cancelled contracts.
+    scores = session.query(User.slack_id, Score.points).join(
+        Score, Score.user_id == User.user_id).filter(
+            Score.contract_id == contract.contract_id).all()
+
+    scoring = ''
+    if scores:
+        scoring = '\n\nscores:\n-------\n' + '\n'.join('%s: %.2f' % (
+            slack_id, points) for (points, slack_id) in sorted(
+                [(v,k) for (k,v) in scores], reverse=True))
+    return scoring
+
+# show summarizes contracts with more predictions than this, or when asked.
+SUMMARY_THRESHOLD = 100
+# How many of the latest predictions a summary lists.
+SUMMARY_RECENT = 10
+# How many users' latest predictions a summary lists, most recent first.
+SUMMARY_POSITIONS = 20
+# How many points the price history in a summary is averaged down to.
+SUMMARY_BUCKETS = 24
+SPARKS = '\u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588'
+
+def sparkline(values):
+    return ''.join(SPARKS[min(int(value * len(SPARKS)), len(SPARKS) - 1)]
+                   for value in values)
+
+def render_summary(session, contract):
+    """Like render_show, but in a size that doesn't grow with the contract.
+
+    Each part is its own aggregate or LIMIT query, so no more than a page of
+    rows reaches Python however many predictions there are.  Header lines
+    have no when_created.
+    """
+    of_contract = Prediction.contract_id == contract.contract_id
+    seconds = db.cast(db.func.extract('epoch', Prediction.when_created),
+                      db.BigInteger)
+    start, end = session.query(db.func.min(seconds),
+                               db.func.max(seconds)).filter(of_contract).one()
+    if start is None:
+        return [], ''
+
+    # Average the values in each of SUMMARY_BUCKETS equal slices of time.
+    # Integer arithmetic so the bucket rounds down on every database.
+    span = end - start + 1
+    bucket = ((seconds - start) * SUMMARY_BUCKETS / span).label('bucket')
+    averages = dict(session.query(
+        bucket, db.func.avg(Prediction.value)).filter(
+            of_contract).group_by(bucket))
+    history = []
+    for i in range(SUMMARY_BUCKETS):
+        # Carry the last price through slices without predictions.
+        history.append(averages.get(i, history[-1] if history else 0))
+
+    latest = session.query(db.func.max(Prediction.prediction_id)).filter(
+        of_contract).group_by(Prediction.user_id).subquery()
+    positions = session.query(
+        Prediction.value, User.slack_id, Prediction.when_created).join(
+            User, User.user_id == Prediction.user_id).filter(
+                Prediction.prediction_id.in_(latest)).order_by(
+                    Prediction.when_created.desc(),
+                    Prediction.prediction_id.desc()).limit(
+                        SUMMARY_POSITIONS).all()
+    # Only a full list needs the count of the users left out.
+    users = len(positions)
+    if users == SUMMARY_POSITIONS:
+        users = session.query(db.func.count(db.distinct(
+            Prediction.user_id))).filter(of_contract).scalar()
+
+    recent = session.query(
+        Prediction.value, User.slack_id, Prediction.when_created).join(
+            User, User.user_id == Prediction.user_id).filter(
+                of_contract).order_by(
+                    Prediction.when_created.desc(),
+                    Prediction.prediction_id.desc()).limit(
+                        SUMMARY_RECENT).all()
+
+    predictions = [
+        ('%d predictions, %.2f%% now\nhistory: %s' % (
+            contract.prediction_count, contract.last_value*100,
+            sparkline(history)), None),
+        ('\nlatest by user:', None)]
+    predictions += [('%.2f%%   %s' % (value*100, slack_id), when_created)
+                    for value, slack_id, when_created in positions]
+    if users > len(positions):
+        predictions.append(('...and %d more' % (users - len(positions)), None))
+    predictions.append(('\nlast %d predictions:' % len(recent), None))
+    predictions += [('%.2f%%   %s' % (value*100, slack_id), when_created)
+                    for value, slack_id, when_created in reversed(recent)]
+    return predictions, render_show_scoring(session, contract)
+
+def rendered_size(rendered):
+    # Roughly the bytes held by a render_show result.
+    predictions, scoring = rendered
+    return sum(len(line) + 120 for line, _ in predictions) + len(scoring)
+
+# render_show and render_summary results by (contract_id, version, mode).
+# Commands never show a contract after changing it in the same transaction, so
+# a cached version is always a committed one.
+show_cache = LRUCache(int(os.environ.get('SHOW_CACHE_BYTES', 32 * 2**20)),
+                      weigh=rendered_size)
+
+@command(read_only=True, usage='<contract_name> [summary|full]')
+def show(session, user, contract_name, mode=None):
+    if mode not in (None, 'summary', 'full'):
+        raise PredictionsError(commands['show'].usage)
     contract = get_contract_or_raise(session, contract_name)
+    if mode is None:
+        mode = ('summary' if contract.prediction_count > SUMMARY_THRESHOLD
+                else 'full')
+
+    key = (contract.contract_id, contract.version, mode)
+    rendered = show_cache.get(key)
+    if rendered is None:
+        render = render_summary if mode == 'summary' else render_show
+        rendered = render(session, contract)
+        show_cache.put(key, rendered)
+    predictions, scoring = rendered
 
     if contract.when_cancelled != None:
         resolution = 'Cancelled'
@@ -160,34 +614,6 @@ def show(session, user, contract_name):
     else:
         resolution = 'Resolved %s' % (contract.resolution)
 
-    predictions = []
-    previous = None
-    seen_non_house = False
-    scores = defaultdict(float)
-    for prediction in session.query(Prediction).filter(
-        Prediction.contract_id == contract.contract_id).order_by(
-            Prediction.when_created):
-        predictions.append('%.2f%%   %s (%s)' % (
-            prediction.value*100, prediction.user.slack_id,
-            dt_to_string(prediction.when_created)))
-
-        if (contract.when_cancelled == None and
-            contract.resolution is not None):
-            if prediction.user_id != contract.user_id:
-                # You don't get points for creating a contract and then betting
-                # on it yourself before anyone else does.  Just treat those as
-                # house odds.
-                seen_non_house = True
-
-            if previous and seen_non_house:
-                if contract.resolution:
-                    ratio = prediction.value / previous.value
-                else:
-                    ratio = (1-prediction.value) / (1-previous.value)
-                points = 100*math.log(ratio)
-                scores[prediction.user.slack_id] += points
-            previous = prediction
-
     dt_now = now()
     if contract.when_closes < dt_now:
         if contract.when_cancelled != None:
@@ -202,15 +628,264 @@ def show(session, user, contract_name):
             close_info = 'Closes %s (%s UTC)\n' % (
                 dt_to_string(contract.when_closes), contract.when_closes)
 
-    scoring = ''
-    if scores:
-        scoring = '\n\nscores:\n-------\n' + '\n'.join('%s: %.2f' % (
-            slack_id, points) for (points, slack_id) in sorted(
-                [(v,k) for (k,v) in scores.items()], reverse=True))
-
     return '%s (%s)\n%s\n%s%s' % (
-        contract.terms, resolution, close_info, '\n'.join(predictions),
-        scoring)
+        contract.terms, resolution, close_info, '\n'.join(
+            '%s (%s)' % (line, dt_to_string(when_created))
+            if when_created else line
+            for line, when_created in predictions), scoring)
+
+def latest_predictions(session, user_id):
+    """Subquery of a user's latest prediction on each contract.
+
+    Reads only that user's predictions, through the index on (user_id,
+    contract_id, when_created).
+    """
+    columns = [Prediction.contract_id, Prediction.value,
+               Prediction.when_created]
+    if session.get_bind().dialect.name == 'postgresql':
+        return session.query(*columns).filter(
+            Prediction.user_id == user_id).distinct(
+                Prediction.contract_id).order_by(
+                    Prediction.contract_id, Prediction.when_created.desc(),
+                    Prediction.prediction_id.desc()).subquery()
+    # Elsewhere, e.g. SQLite before window functions, take the newest
+    # prediction_id, as render_summary does.
+    latest = session.query(db.func.max(Prediction.prediction_id)).filter(
+        Prediction.user_id == user_id).group_by(Prediction.contract_id)
+    return session.query(*columns).filter(
+        Prediction.prediction_id.in_(latest.subquery())).subquery()
+
+@command(read_only=True)
+def mine(session, user):
+    # The market's side comes from contract.last_value, which predict keeps
+    # up to date.
+    latest = latest_predictions(session, user.user_id)
+    rows = session.query(
+        Contract.name, latest.c.value, Contract.last_value,
+        Contract.when_closes).join(
+            latest, latest.c.contract_id == Contract.contract_id).filter(
+                *active_filters()).order_by(
+                    Contract.when_closes, Contract.name).all()
+    if not rows:
+        return 'you have no predictions on active contracts'
+    return '\n'.join('%s   you %.2f%%, now %.2f%% (closes %s)' % (
+        name, value*100, last_value*100, dt_to_string(when_closes))
+                     for name, value, last_value, when_closes in rows)
+
+# How many contracts search lists, and get_contract_or_raise suggests.
+SEARCH_LIMIT = 10
+SUGGESTIONS = 3
+
+def search_words(text):
+    return re.findall(r'\w+', text.lower())
+
+class SearchIndex(object):
+    """In-memory inverted index over contract names and terms.
+
+    Contracts are never renamed or deleted, so the index catches up by
+    contract_id before each search.  It's rebuilt if it ever disagrees with
+    the database, e.g. after a rolled-back contract's id is reused.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._postings = defaultdict(set)
+        # The words in _postings, sorted so that prefixes are a range.
+        self._words = []
+        self._names = {}
+        self._last_id = 0
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    def _clear(self):
+        self._postings.clear()
+        del self._words[:]
+        self._names.clear()
+        self._last_id = 0
+
+    def _update(self, session):
+        for contract_id, name, terms in session.query(
+                Contract.contract_id, Contract.name, Contract.terms).filter(
+                    Contract.contract_id > self._last_id).order_by(
+                        Contract.contract_id):
+            for word in set(search_words(name + ' ' + terms)):
+                if word not in self._postings:
+                    bisect.insort(self._words, word)
+                self._postings[word].add(contract_id)
+            self._names[contract_id] = name
+            self._last_id = contract_id
+
+    def _rank(self, words, limit):
+        # Each word may be the start of a word in the contract.  Rank by how
+        # many of them match.
+        matches = defaultdict(int)
+        for word in set(words):
+            ids = set()
+            i = bisect.bisect_left(self._words, word)
+            while (i < len(self._words) and
+                   self._words[i].startswith(word)):
+                ids |= self._postings[self._words[i]]
+                i += 1
+            for contract_id in ids:
+                matches[contract_id] += 1
+        return sorted(matches, key=lambda contract_id: (
+            -matches[contract_id], self._names[contract_id]))[:limit]
+
+    def search(self, session, words, limit):
+        """Returns up to limit (name, terms), best match first."""
+        with self._lock:
+            for attempt in range(2):
+                self._update(session)
+                ids = self._rank(words, limit)
+                rows = {}
+                if ids:
+                    rows = dict((row.contract_id, row)
+                                for row in session.query(
+                                    Contract.contract_id, Contract.name,
+                                    Contract.terms).filter(
+                                        Contract.contract_id.in_(ids)))
+                if all(contract_id in rows and
+                       rows[contract_id].name == self._names[contract_id]
+                       for contract_id in ids):
+                    break
+                self._clear()
+        return [(rows[contract_id].name, rows[contract_id].terms)
+                for contract_id in ids]
+
+search_index = SearchIndex()
+
+def search_contracts(session, text, limit):
+    """Contracts with words in their names or terms starting with text's.
+
+    Returns up to limit (name, terms), best match first.
+    """
+    words = search_words(text)
+    if not words:
+        return []
+    if session.get_bind().dialect.name != 'postgresql':
+        return search_index.search(session, words, limit)
+
+    # The same expression as ix_contract_search, so that the index is used.
+    document = db.func.to_tsvector(db.literal_column("'simple'"),
+                                   Contract.name + ' ' + Contract.terms)
+    query = db.func.to_tsquery(db.literal_column("'simple'"), ' | '.join(
+        "'%s':*" % word for word in words))
+    return session.query(Contract.name, Contract.terms).filter(
+        document.op('@@')(query)).order_by(
+            db.func.ts_rank(document, query).desc(), Contract.name).limit(
+                limit).all()
+
+@command(read_only=True, usage='<words> ...')
+def search(session, user, *words):
+    if not words:
+        raise PredictionsError(commands['search'].usage)
+    rows = search_contracts(session, ' '.join(words), SEARCH_LIMIT)
+    if not rows:
+        return 'no contracts match %s' % ' '.join(words)
+    return '\n'.join('%s   %s' % (name, terms if len(terms) <= 60
+                                   else terms[:57] + '...')
+                     for name, terms in rows)
+
+@command(read_only=True)
+def leaderboard(session, user, days=None):
+    if days is None:
+        title = 'leaderboard'
+        rows = session.query(User.slack_id, User.score).filter(
+            User.scored_contracts > 0).order_by(
+                User.score.desc(), User.slack_id)
+    else:
+        try:
+            if not float(days) > 0:
+                raise ValueError(days)
+            since = now() - datetime.timedelta(days=float(days))
+        except (ValueError, OverflowError):
+            raise PredictionsError('%s is not a valid number of days' % days)
+        title = 'leaderboard (last %s days)' % days
+        points = db.func.sum(Score.points)
+        rows = session.query(User.slack_id, points).join(
+            Score, Score.user_id == User.user_id).filter(
+                Score.when_resolved >= since).group_by(
+                    User.slack_id).order_by(points.desc(), User.slack_id)
+
+    rows = rows.all()
+    if not rows:
+        return 'no resolved contracts'
+    return '%s:\n-------\n%s' % (title, '\n'.join(
+        '%d. %s: %.2f' % (i+1, slack_id, points)
+        for i, (slack_id, points) in enumerate(rows)))
+
+# Number of equal-width probability buckets in the calibration report.
+CALIBRATION_BUCKETS = 10
+
+@command(read_only=True, usage='[<user-name>|team]')
+def calibration(session, user, who=None):
+    team = who == 'team'
+    if team:
+        title = 'team calibration'
+    else:
+        if who is not None and who != user.slack_id:
+            user = session.query(User).filter(
+                User.slack_id == who).one_or_none()
+            if user is None:
+                raise PredictionsError('unknown user %s' % who)
+        title = 'calibration for %s' % user.slack_id
+
+    # One bulk query for the raw columns; the bucketing is done with array
+    # operations, since the team report covers every prediction ever made.
+    query = session.query(Prediction.value, Contract.resolution).join(
+        Contract, Contract.contract_id == Prediction.contract_id).filter(
+            *resolved_filters())
+    if not team:
+        # No user_id, and so no predictions, for a user who's never written.
+        query = query.filter(Prediction.user_id == user.user_id)
+    rows = session.execute(query.statement).fetchall()
+    if not rows:
+        return '%s: no predictions on resolved contracts' % title
+
+    # numpy is slow to import, and only needed here.
+    import numpy
+    data = numpy.array(rows, dtype=float)
+    values, outcomes = data[:, 0], data[:, 1]
+    errors = (values - outcomes) ** 2
+    buckets = numpy.minimum((values * CALIBRATION_BUCKETS).astype(int),
+                            CALIBRATION_BUCKETS - 1)
+    counts = numpy.bincount(buckets, minlength=CALIBRATION_BUCKETS)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        observed = numpy.bincount(
+            buckets, weights=outcomes, minlength=CALIBRATION_BUCKETS) / counts
+        brier = numpy.bincount(
+            buckets, weights=errors, minlength=CALIBRATION_BUCKETS) / counts
+
+    width = 100 // CALIBRATION_BUCKETS
+    lines = ['%-8s %11d %8.2f%% %6.3f' % (
+        '%d-%d%%' % (i * width, (i+1) * width), counts[i],
+        observed[i] * 100, brier[i]) for i in numpy.flatnonzero(counts)]
+    return '%s (%d predictions, Brier score %.3f):\n%s\n%s' % (
+        title, len(values), errors.mean(),
+        'stated   predictions  observed  Brier', '\n'.join(lines))
+
+# parsedatetime, pytz and tzlocal are slow to import and only create needs
+# them, so they're loaded by the first create rather than at startup.
+date_parser = None
+date_parser_lock = threading.Lock()
+
+def parse_when_closes(when_closes):
+    """Parses a time in the server's timezone into naive UTC."""
+    global date_parser
+    # One calendar and timezone for every request.  The calendar keeps its
+    # parsing state on itself, so only one thread may use it at a time.
+    with date_parser_lock:
+        if date_parser is None:
+            import pytz
+            import tzlocal
+            import parsedatetime
+            date_parser = (parsedatetime.Calendar(), tzlocal.get_localzone(),
+                           pytz.utc)
+        calendar, local, utc = date_parser
+        when_closes, _ = calendar.parseDT(when_closes, tzinfo=local)
+    return when_closes.astimezone(utc).replace(tzinfo=None)
 
 @command
 def create(session, user, contract_name, terms, when_closes, house_odds):
@@ -220,12 +895,10 @@ def create(session, user, contract_name, terms, when_closes, house_odds):
                                contract_name)
 
     try:
-        when_closes, _ = parsedatetime.Calendar().parseDT(
-            when_closes, tzinfo=tzlocal.get_localzone())
+        when_closes = parse_when_closes(when_closes)
     except ValueError:
         raise PredictionsError('Couldn\'t interpret "%s" as a datetime' %
                                when_closes)
-    when_closes = when_closes.astimezone(pytz.utc).replace(tzinfo=None)
     session.add(Contract(name=contract_name, terms=terms,
                          user_id=user.user_id, when_closes=when_closes))
     # set the house odds
@@ -233,22 +906,20 @@ def create(session, user, contract_name, terms, when_closes, house_odds):
     return 'Created contract %s open until %s' % (
         contract_name, dt_to_string(when_closes))
 
-@command
-def predict(session, user, contract_name, percentage):
-    contract = get_contract_or_raise(session, contract_name)
-
+def check_can_predict(contract):
     if contract.resolution != None:
         raise PredictionsError('contract %s is already resolved' %
-                               contract_name)
+                               contract.name)
 
     if contract.when_cancelled != None:
         raise PredictionsError('contract %s was cancelled' %
-                               contract_name)
+                               contract.name)
 
     if contract.when_closes < now():
         raise PredictionsError('contract %s closed at %s' %
-                               (contract_name, contract.when_closes))
+                               (contract.name, contract.when_closes))
 
+def parse_percentage(percentage):
     try:
         if '%' in percentage:
             value = float(percentage.replace('%', '')) / 100
@@ -261,11 +932,76 @@ def predict(session, user, contract_name, percentage):
          raise PredictionsError('percentage >= 100%%: %s' % percentage)
     elif value <= 0:
          raise PredictionsError('percentage <= 0%%: %s' % percentage)
+    return value
+
+def add_predictions(session, user, values):
+    """Records (contract, value) pairs that have already been checked.
 
-    session.add(Prediction(value=value, user_id=user.user_id,
-                           contract_id=contract.contract_id))
+    All the rows go in with one INSERT, and the contracts' latest price,
+    prediction count and version move in one UPDATE.  A concurrent predict
+    with a later time may already have moved the price, so it's only moved
+    forward.
+    """
+    when = now()
+    session.execute(Prediction.__table__.insert().values([
+        dict(value=value, user_id=user.user_id,
+             contract_id=contract.contract_id, when_created=when)
+        for contract, value in values]))
+    newer = db.or_(Contract.when_last_predicted == None,
+                   Contract.when_last_predicted <= when)
+    session.query(Contract).filter(Contract.contract_id.in_([
+        contract.contract_id for contract, _ in values])).update({
+            Contract.last_value: db.case([(newer, db.case(
+                {contract.contract_id: value for contract, value in values},
+                value=Contract.contract_id))], else_=Contract.last_value),
+            Contract.when_last_predicted: db.case(
+                [(newer, when)], else_=Contract.when_last_predicted),
+            Contract.prediction_count: Contract.prediction_count + 1,
+            Contract.version: Contract.version + 1,
+        }, synchronize_session=False)
+    for contract, _ in values:
+        session.expire(contract)
+
+@command
+def predict(session, user, contract_name, percentage):
+    contract = get_contract_or_raise(session, contract_name)
+    check_can_predict(contract)
+    value = parse_percentage(percentage)
+    add_predictions(session, user, [(contract, value)])
     return 'Added prediction for %s at %s%%' % (contract_name, value*100)
 
+@command(usage='<contract-name>=<percentage> ...')
+def batch(session, user, *predictions):
+    if not predictions:
+        raise PredictionsError(commands['batch'].usage)
+
+    parsed = []
+    for prediction in predictions:
+        contract_name, _, percentage = prediction.rpartition('=')
+        if not contract_name:
+            raise PredictionsError(
+                'expected <contract-name>=<percentage>, got "%s"' %
+                prediction)
+        if contract_name in [name for name, _ in parsed]:
+            raise PredictionsError('contract %s is listed more than once' %
+                                   contract_name)
+        parsed.append((contract_name, parse_percentage(percentage)))
+
+    # Check everything before writing anything, so it's all or nothing.
+    contracts = {contract.name: contract for contract in session.query(
+        Contract).filter(Contract.name.in_([name for name, _ in parsed]))}
+    values = []
+    for contract_name, value in parsed:
+        if contract_name not in contracts:
+            raise PredictionsError('unknown contract %s' % contract_name)
+        check_can_predict(contracts[contract_name])
+        values.append((contracts[contract_name], value))
+
+    add_predictions(session, user, values)
+    return 'Added predictions for %s' % ', '.join(
+        '%s at %s%%' % (contract_name, value*100)
+        for contract_name, value in parsed)
+
 @command
 def resolve(session, user, contract_name, resolution):
     contract = get_contract_or_raise(session, contract_name)
@@ -285,6 +1021,9 @@ def resolve(session, user, contract_name, resolution):
 
     contract.resolution = (resolution.lower() == 'true')
     contract.when_resolved = now()
+    bump_version(contract)
+    if contract.when_cancelled == None:
+        record_scores(session, contract)
     return 'Contract %s resolved as %s' % (contract_name, contract.resolution)
 
 @command
@@ -300,59 +1039,877 @@ def cancel(session, user, contract_name):
              contract.user.slack_id, contract_name))
 
     contract.when_cancelled = now()
+    bump_version(contract)
+    # Cancelling a resolved contract takes its points back.
+    clear_scores(session, contract)
     return 'Contract %s cancelled' % contract_name
 
-def lookup_or_create_user(session, slack_id):
+# slack_id -> user_id.  A user created in the current transaction isn't
+# cached until a later transaction finds it, since the insert might still be
+# rolled back.
+user_cache = LRUCache(int(os.environ.get('USER_CACHE_SIZE', 10000)))
+
+@db.event.listens_for(db.Session, 'after_transaction_end')
+def forget_created_users(session, transaction):
+    if transaction.parent is None:
+        session.info.pop('created_slack_ids', None)
+
+def lookup_or_create_user(session, slack_id, create=True):
+    """The user with this slack_id, created if need be.
+
+    With create=False, as for read-only commands, a new user comes back
+    unsaved and without a user_id.
+    """
+    user_id = user_cache.get(slack_id)
+    if user_id is not None:
+        # Attach the user to the session without a SELECT.
+        user = User(slack_id=slack_id)
+        user.user_id = user_id
+        make_transient_to_detached(user)
+        return session.merge(user, load=False)
+
     user = session.query(User).filter(
         User.slack_id == slack_id).one_or_none()
     if user:
+        if slack_id not in session.info.get('created_slack_ids', ()):
+            user_cache.put(slack_id, user.user_id)
         return user
+    if not create:
+        return User(slack_id=slack_id)
+    return create_user(session, slack_id)
 
+def create_user(session, slack_id):
     user = User(slack_id=slack_id)
-    session.add(user)
+    try:
+        with session.begin_nested():
+            session.add(user)
+        session.info.setdefault('created_slack_ids', set()).add(slack_id)
+    except IntegrityError:
+        # Another request created the same user after we looked.
+        user = session.query(User).filter(User.slack_id == slack_id).one()
     return user
 
+@migration
+def add_score_ledger_and_indexes(connection):
+    """score ledger, leaderboard totals and lookup indexes"""
+    for statement in [
+            '''CREATE TABLE IF NOT EXISTS score (
+                   contract_id INTEGER NOT NULL
+                       REFERENCES contract (contract_id),
+                   user_id INTEGER NOT NULL REFERENCES "user" (user_id),
+                   points FLOAT NOT NULL,
+                   when_resolved TIMESTAMP NOT NULL,
+                   PRIMARY KEY (contract_id, user_id))''',
+            'CREATE INDEX IF NOT EXISTS ix_score_when_resolved '
+            'ON score (when_resolved)',
+            'ALTER TABLE "user" ADD COLUMN score FLOAT NOT NULL DEFAULT 0',
+            'ALTER TABLE "user" ADD COLUMN scored_contracts INTEGER NOT NULL '
+            'DEFAULT 0',
+            'CREATE INDEX IF NOT EXISTS ix_prediction_contract_id_when_created '
+            'ON prediction (contract_id, when_created)',
+            'CREATE INDEX IF NOT EXISTS ix_prediction_user_id '
+            'ON prediction (user_id)',
+            'CREATE INDEX IF NOT EXISTS ix_contract_when_closes '
+            'ON contract (when_closes)',
+            'CREATE INDEX IF NOT EXISTS ix_contract_resolution '
+            'ON contract (resolution)',
+            'CREATE INDEX IF NOT EXISTS ix_contract_when_cancelled '
+            'ON contract (when_cancelled)']:
+        connection.execute(statement)
+
+    # Backfill the ledger with the scoring rules as they were, rather than
+    # calling rescore_all, which follows the current models.
+    connection.execute('DELETE FROM score')
+    for contract_id, creator_id, resolution, when_resolved in (
+            connection.execute(
+                'SELECT contract_id, user_id, resolution, when_resolved '
+                'FROM contract WHERE resolution IS NOT NULL '
+                'AND when_cancelled IS NULL').fetchall()):
+        previous = None
+        seen_non_house = False
+        scores = defaultdict(float)
+        for user_id, value in connection.execute(db.text(
+                'SELECT user_id, value FROM prediction '
+                'WHERE contract_id = :contract_id '
+                'ORDER BY when_created, prediction_id'),
+                contract_id=contract_id).fetchall():
+            if user_id != creator_id:
+                seen_non_house = True
+            if previous is not None and seen_non_house:
+                if resolution:
+                    ratio = value / previous
+                else:
+                    ratio = (1-value) / (1-previous)
+                scores[user_id] += 100*math.log(ratio)
+            previous = value
+        for user_id, points in scores.items():
+            connection.execute(db.text(
+                'INSERT INTO score (contract_id, user_id, points, '
+                'when_resolved) VALUES (:contract_id, :user_id, :points, '
+                ':when_resolved)'), contract_id=contract_id, user_id=user_id,
+                points=points, when_resolved=when_resolved)
+            connection.execute(db.text(
+                'UPDATE "user" SET score = score + :points, '
+                'scored_contracts = scored_contracts + 1 '
+                'WHERE user_id = :user_id'), points=points, user_id=user_id)
+
+@migration
+def add_list_indexes(connection):
+    """partial indexes on contract names for paging the list commands"""
+    for name, where in [
+            ('ix_contract_active_name',
+             'resolution IS NULL AND when_cancelled IS NULL'),
+            ('ix_contract_resolved_name',
+             'resolution IS NOT NULL AND when_cancelled IS NULL'),
+            ('ix_contract_cancelled_name', 'when_cancelled IS NOT NULL')]:
+        connection.execute('CREATE INDEX IF NOT EXISTS %s ON contract (name) '
+                           'WHERE %s' % (name, where))
+
+@migration
+def add_contract_market_columns(connection):
+    """latest prediction and prediction count on contract"""
+    for statement in [
+            'ALTER TABLE contract ADD COLUMN last_value FLOAT',
+            'ALTER TABLE contract ADD COLUMN when_last_predicted TIMESTAMP',
+            'ALTER TABLE contract ADD COLUMN prediction_count INTEGER '
+            'NOT NULL DEFAULT 0',
+            '''UPDATE contract SET
+                   prediction_count = (
+                       SELECT count(*) FROM prediction
+                       WHERE prediction.contract_id = contract.contract_id),
+                   when_last_predicted = (
+                       SELECT max(when_created) FROM prediction
+                       WHERE prediction.contract_id = contract.contract_id),
+                   last_value = (
+                       SELECT value FROM prediction
+                       WHERE prediction.contract_id = contract.contract_id
+                       ORDER BY when_created DESC, prediction_id DESC
+                       LIMIT 1)''']:
+        connection.execute(statement)
+
+@migration
+def add_contract_version(connection):
+    """contract version counter for caching show"""
+    connection.execute(
+        'ALTER TABLE contract ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+
+@migration
+def add_prediction_user_contract_index(connection):
+    """index on prediction (user_id, contract_id, when_created) for mine"""
+    connection.execute(
+        'CREATE INDEX IF NOT EXISTS '
+        'ix_prediction_user_id_contract_id_when_created '
+        'ON prediction (user_id, contract_id, when_created)')
+    # The new index covers lookups by user_id alone.
+    connection.execute('DROP INDEX IF EXISTS ix_prediction_user_id')
+
+@migration
+def add_contract_search_index(connection):
+    """full-text index on contract names and terms, on postgres"""
+    if connection.dialect.name == 'postgresql':
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS ix_contract_search ON contract "
+            "USING gin (to_tsvector('simple', name || ' ' || terms))")
+
+def migrate(engine=None):
+    """Brings a database up to the latest schema version.
+
+    A database without any tables is created from the models directly.
+    Returns the migrations that were applied.
+    """
+    engine = engine or db.engine
+    with engine.begin() as connection:
+        if not engine.dialect.has_table(connection, User.__tablename__):
+            db.Model.metadata.create_all(connection)
+            connection.execute(SchemaVersion.__table__.insert(), [
+                dict(version=version, when_applied=now())
+                for version in range(1, len(migrations)+1)])
+            return []
+        SchemaVersion.__table__.create(connection, checkfirst=True)
+        current = connection.execute(db.select([
+            db.func.coalesce(db.func.max(SchemaVersion.version), 0)])).scalar()
+
+    applied = []
+    for version, fn in enumerate(migrations[current:], current+1):
+        with engine.begin() as connection:
+            fn(connection)
+            connection.execute(SchemaVersion.__table__.insert(), dict(
+                version=version, when_applied=now()))
+        applied.append(fn)
+    return applied
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Apply pending schema migrations."""
+    applied = migrate()
+    for fn in applied:
+        print('applied %s: %s' % (fn.__name__, fn.__doc__))
+    if not applied:
+        print('schema is up to date')
+
+# Tables covered by export and import, in an order that satisfies the foreign
+# keys.  The score ledger is derived, so import rebuilds it instead.
+DUMP_TABLES = [User.__table__, Contract.__table__, Prediction.__table__]
+DUMP_BATCH_SIZE = 10000
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = [*itertools.islice(iterator, size)]
+        if not batch:
+            return
+        yield batch
+
+def parse_datetime(value):
+    for fmt in ['%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S']:
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError('bad datetime %r' % value)
+
+def parse_value(column, value):
+    """Converts a value read from a JSONL or CSV dump back to column's type."""
+    if value is None or (value == '' and column.nullable):
+        return None
+    if isinstance(column.type, db.DateTime):
+        return parse_datetime(value)
+    if isinstance(column.type, db.Boolean):
+        return value if isinstance(value, bool) else value == 'True'
+    if isinstance(column.type, db.Integer):
+        return int(value)
+    if isinstance(column.type, db.Float):
+        return float(value)
+    return value
+
+def export_tables(connection, directory, fmt='jsonl'):
+    """Streams each table to <directory>/<table>.<fmt>.
+
+    Rows are read through a server-side cursor where the database supports
+    one, a batch at a time, so memory use doesn't grow with the tables.
+    Returns the number of rows written per table.
+    """
+    counts = {}
+    for table in DUMP_TABLES:
+        columns = [column.name for column in table.columns]
+        result = connection.execution_options(stream_results=True).execute(
+            table.select().order_by(*table.primary_key.columns))
+        path = os.path.join(directory, '%s.%s' % (table.name, fmt))
+        with open(path, 'w', newline='') as f:
+            if fmt == 'csv':
+                # NULLs come out as empty fields.  Only non-text columns are
+                # nullable, so import can read every empty value in a
+                # nullable column back as NULL.
+                writer = csv.writer(f)
+                writer.writerow(columns)
+            counts[table.name] = 0
+            for rows in iter(lambda: result.fetchmany(DUMP_BATCH_SIZE), []):
+                for row in rows:
+                    values = [value.isoformat()
+                              if isinstance(value, datetime.datetime)
+                              else value for value in row]
+                    if fmt == 'csv':
+                        writer.writerow(values)
+                    else:
+                        f.write(json.dumps(dict(zip(columns, values))) + '\n')
+                counts[table.name] += len(rows)
+    return counts
+
+def read_dump(path, table):
+    """Yields (columns, rows) for one table's dump, rows lazily."""
+    f = open(path, newline='')
+    if path.endswith('.csv'):
+        reader = csv.reader(f)
+        columns = next(reader)
+    else:
+        lines = (json.loads(line) for line in f if line.strip())
+        first = next(lines, None)
+        columns = [*first] if first else []
+        reader = ([row[name] for name in columns]
+                  for row in itertools.chain([first] if first else [], lines))
+
+    def rows():
+        with f:
+            for values in reader:
+                yield [parse_value(table.columns[name], value)
+                       for name, value in zip(columns, values)]
+    return columns, rows()
+
+def copy_value(value):
+    """Formats a value for COPY's default text format."""
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace(
+        '\n', '\\n').replace('\r', '\\r')
+
+def copy_rows(connection, table, columns, rows):
+    """Bulk loads rows with Postgres's COPY, one batch at a time."""
+    cursor = connection.connection.cursor()
+    sql = 'COPY %s (%s) FROM STDIN' % (
+        connection.dialect.identifier_preparer.format_table(table),
+        ', '.join(columns))
+    count = 0
+    for batch in batches(rows, DUMP_BATCH_SIZE):
+        cursor.copy_expert(sql, io.StringIO(''.join(
+            '\t'.join(copy_value(value) for value in values) + '\n'
+            for values in batch)))
+        count += len(batch)
+    return count
+
+def import_tables(connection, directory):
+    """Loads a dump written by export_tables into empty tables.
+
+    IDs and timestamps are kept as they are in the dump.  Returns the number
+    of rows loaded per table.
+    """
+    postgres = connection.dialect.name == 'postgresql'
+    counts = {}
+    for table in DUMP_TABLES:
+        paths = [os.path.join(directory, '%s.%s' % (table.name, fmt))
+                 for fmt in ['jsonl', 'csv']]
+        paths = [path for path in paths if os.path.exists(path)]
+        if not paths:
+            raise click.ClickException('no dump of %s in %s' % (
+                table.name, directory))
+        columns, rows = read_dump(paths[0], table)
+        if postgres:
+            counts[table.name] = copy_rows(connection, table, columns, rows)
+        else:
+            counts[table.name] = 0
+            for batch in batches(rows, DUMP_BATCH_SIZE):
+                connection.execute(table.insert(), [
+                    dict(zip(columns, values)) for values in batch])
+                counts[table.name] += len(batch)
+
+    if postgres:
+        # The rows came with their own ids, so move the sequences past them.
+        for table in DUMP_TABLES:
+            [pk] = table.primary_key.columns
+            connection.execute(
+                'SELECT setval(pg_get_serial_sequence(%%s, %%s), '
+                'coalesce(max(%s), 0) + 1, false) FROM %s' % (
+                    pk.name, connection.dialect.identifier_preparer.
+                    format_table(table)), table.name, pk.name)
+
+    session = db.Session(bind=connection)
+    rescore_all(session)
+    session.flush()
+    session.close()
+    return counts
+
+@app.cli.command('export')
+@click.argument('directory')
+@click.option('--format', 'fmt', type=click.Choice(['jsonl', 'csv']),
+              default='jsonl')
+def export_command(directory, fmt):
+    """Dump users, contracts and predictions to DIRECTORY."""
+    os.makedirs(directory, exist_ok=True)
+    connection = db.engine.connect()
+    if connection.dialect.name == 'postgresql':
+        # One snapshot across all the tables.
+        connection = connection.execution_options(
+            isolation_level='REPEATABLE READ')
+    with connection.begin():
+        counts = export_tables(connection, directory, fmt)
+    connection.close()
+    for table in DUMP_TABLES:
+        print('%s: %d rows' % (table.name, counts[table.name]))
+
+@app.cli.command('import')
+@click.argument('directory')
+def import_command(directory):
+    """Load a dump from DIRECTORY into an empty, migrated database."""
+    with db.engine.begin() as connection:
+        counts = import_tables(connection, directory)
+    for table in DUMP_TABLES:
+        print('%s: %d rows' % (table.name, counts[table.name]))
+
+class WorkerPool(object):
+    """A fixed set of threads working through a bounded queue of jobs."""
+
+    def __init__(self, threads, max_queued):
+        self.threads = threads
+        self._queue = queue.Queue(max_queued)
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def submit(self, fn, *args):
+        """Queues fn(*args).  Returns False if the queue is full."""
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self._queue.put_nowait((fn, args))
+        except queue.Full:
+            return False
+        return True
+
+    def join(self):
+        """Waits for every queued job to finish."""
+        self._queue.join()
+
+    def _start(self):
+        # Threads don't survive a fork, so start them in whichever process
+        # first submits a job.
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            for _ in range(self.threads):
+                threading.Thread(target=self._work, daemon=True).start()
+            self._pid = os.getpid()
+
+    def _work(self):
+        while True:
+            fn, args = self._queue.get()
+            try:
+                fn(*args)
+            except Exception:
+                app.logger.exception('background job %s failed', fn.__name__)
+            finally:
+                self._queue.task_done()
+
+worker_pool = WorkerPool(int(os.environ.get('WORKER_THREADS', 4)),
+                         int(os.environ.get('WORKER_QUEUE_SIZE', 100)))
+
+# Upper bounds of the latency histogram buckets, in seconds.
+LATENCY_BUCKETS = [.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10]
+
+class Metrics(object):
+    """Per-command counters for this worker, in Prometheus's text format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = defaultdict(lambda: [0] * (len(LATENCY_BUCKETS)+1))
+            self.request_seconds = defaultdict(float)
+            self.statements = defaultdict(int)
+            self.db_seconds = defaultdict(float)
+            self.errors = defaultdict(int)
+
+    @contextlib.contextmanager
+    def track(self, command_name, text):
+        """Times a command and the SQL it runs.
+
+        The block may set .error on the yielded object to 'user' for a
+        PredictionsError; an exception escaping it counts as 'unexpected'.
+        """
+        current = self._local
+        current.statements = 0
+        current.db_seconds = 0.0
+        slow_ms = app.config['SLOW_REQUEST_MS']
+        current.trace = [] if slow_ms is not None else None
+        current.error = None
+        start = time.perf_counter()
+        try:
+            yield current
+        except Exception:
+            current.error = 'unexpected'
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            bucket = len([b for b in LATENCY_BUCKETS if b < elapsed])
+            with self._lock:
+                self.requests[command_name][bucket] += 1
+                self.request_seconds[command_name] += elapsed
+                self.statements[command_name] += current.statements
+                self.db_seconds[command_name] += current.db_seconds
+                if current.error:
+                    self.errors[command_name, current.error] += 1
+            if current.trace is not None and elapsed * 1000 > slow_ms:
+                app.logger.warning(
+                    'slow command (%.0fms, %d statements, %.0fms in db): %s'
+                    '\n%s', elapsed * 1000, current.statements,
+                    current.db_seconds * 1000, text, '\n'.join(
+                        '  %.1fms  %s' % (seconds * 1000, statement)
+                        for seconds, statement in current.trace))
+            current.statements = None
+
+    def record_statement(self, statement, seconds):
+        current = self._local
+        if getattr(current, 'statements', None) is None:
+            return  # Not inside a command, e.g. a migration.
+        current.statements += 1
+        current.db_seconds += seconds
+        if current.trace is not None:
+            current.trace.append((seconds, statement))
+
+    def render(self):
+        lines = []
+        def metric(name, kind, help_text, samples):
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for suffix, labels, value in samples:
+                lines.append('%s%s{%s} %s' % (name, suffix, ','.join(
+                    '%s="%s"' % label for label in labels), value))
+
+        with self._lock:
+            samples = []
+            for command_name, counts in sorted(self.requests.items()):
+                labels = [('command', command_name)]
+                total = 0
+                for le, count in zip(LATENCY_BUCKETS + ['+Inf'], counts):
+                    total += count
+                    samples.append(('_bucket', labels + [('le', le)], total))
+                samples.append(('_sum', labels,
+                                self.request_seconds[command_name]))
+                samples.append(('_count', labels, total))
+            metric('predictions_request_seconds', 'histogram',
+                   'Time to run each command.', samples)
+            metric('predictions_sql_statements_total', 'counter',
+                   'SQL statements run by each command.',
+                   [('', [('command', name)], count)
+                    for name, count in sorted(self.statements.items())])
+            metric('predictions_sql_seconds_total', 'counter',
+                   'Time spent waiting on the database by each command.',
+                   [('', [('command', name)], seconds)
+                    for name, seconds in sorted(self.db_seconds.items())])
+            metric('predictions_errors_total', 'counter',
+                   'Failed commands, by whether it was a PredictionsError.',
+                   [('', [('command', name), ('kind', kind)], count)
+                    for (name, kind), count in sorted(self.errors.items())])
+
+        samples = []
+        for name, cache in [('user', user_cache), ('show', show_cache)]:
+            samples.append(('', [('cache', name), ('result', 'hit')],
+                            cache.hits))
+            samples.append(('', [('cache', name), ('result', 'miss')],
+                            cache.misses))
+        metric('predictions_cache_lookups_total', 'counter',
+               'Lookups in the in-process caches.', samples)
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+# Statement start times go on the execution context, which is dropped with
+# the statement even if it fails and after_cursor_execute never runs.  The
+# few internal statements without one, e.g. for sequences, share a slot on
+# the connection.
+@db.event.listens_for(Engine, 'before_cursor_execute')
+def start_statement_timer(connection, cursor, statement, parameters, context,
+                          executemany):
+    if context is not None:
+        context.statement_start = time.perf_counter()
+    else:
+        connection.info['statement_start'] = time.perf_counter()
+
+@db.event.listens_for(Engine, 'after_cursor_execute')
+def stop_statement_timer(connection, cursor, statement, parameters, context,
+                         executemany):
+    if context is not None:
+        start = context.statement_start
+    else:
+        start = connection.info.pop('statement_start')
+    metrics.record_statement(statement, time.perf_counter() - start)
+
+# Sessions for read-only commands on the READ_DATABASE_URL engine.  Without
+# one, they use db.session like everything else.
+read_session = None
+if app.config['READ_DATABASE_URL']:
+    read_session = db.create_scoped_session(options=dict(
+        bind=db.get_engine(app, bind='read'), binds={}))
+
+@app.teardown_appcontext
+def remove_read_session(exception):
+    if read_session is not None:
+        read_session.remove()
+
+def run_command(user_name, text):
+    """Runs a slash command and returns the Slack message to reply with."""
+    args = shlex.split(text)
+    spec = commands['predict']
+    if args and args[0] in commands:
+        spec = commands[args[0]]
+        args = args[1:]
+
+    with metrics.track(spec.name, text) as tracking:
+        try:
+            session = db.session
+            if spec.read_only and read_session is not None:
+                session = read_session
+            if not spec.min_args <= len(args) <= spec.max_args:
+                raise PredictionsError(spec.usage)
+
+            user = lookup_or_create_user(session, user_name,
+                                         create=not spec.read_only)
+            response = spec.fn(session, user, *args)
+            if not spec.read_only:
+                session.commit()
+        except Exception as e:
+            session.rollback()
+            if isinstance(e, PredictionsError):
+                tracking.error = 'user'
+                return dict(response_type='ephemeral',
+                            text='Error: %s' % str(e))
+            else:
+                raise
+        finally:
+            session.close()
+
+    return dict(response_type='in_channel', text=response)
+
+def post_to_response_url(response_url, message):
+    urllib.request.urlopen(urllib.request.Request(
+        response_url, data=json.dumps(message).encode('utf-8'),
+        headers={'Content-Type': 'application/json'}), timeout=10).close()
+
+class PendingResponse(object):
+    """The eventual reply to a command, which retries of it can wait for."""
+
+    def __init__(self, expires):
+        self.expires = expires
+        self.message = None
+        self._done = threading.Event()
+
+    def finish(self, message):
+        self.message = message
+        self._done.set()
+
+    def wait(self, timeout):
+        """Returns the reply, or None if it failed or isn't ready in time."""
+        self._done.wait(timeout)
+        return self.message
+
+class RecentResponses(object):
+    """Bounded, expiring store of replies to recent commands by request key."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def claim(self, key):
+        """Returns (pending, first).
+
+        first is True if this is the first time key has been seen recently,
+        in which case the caller must run the command and finish pending, or
+        forget the key if that fails.
+        """
+        with self._lock:
+            clock = time.monotonic()
+            while self._items:
+                oldest = next(iter(self._items.values()))
+                if oldest.expires > clock and len(self._items) < self.max_size:
+                    break
+                self._items.popitem(last=False)
+            if key in self._items:
+                return self._items[key], False
+            pending = PendingResponse(clock + app.config['DEDUPE_SECONDS'])
+            self._items[key] = pending
+            return pending, True
+
+    def forget(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+recent_responses = RecentResponses(
+    int(os.environ.get('RECENT_RESPONSES_SIZE', 10000)))
+
+class TokenBuckets(object):
+    """Token buckets by key, in this worker's memory.
+
+    The least recently used buckets are evicted beyond max_size.  They'd
+    have refilled by then anyway, unless the limits are very slow.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, per_second, burst):
+        """Takes a token from key's bucket, or returns False if it's empty."""
+        with self._lock:
+            clock = time.monotonic()
+            tokens, updated = self._buckets.pop(key, (burst, clock))
+            tokens = min(burst, tokens + (clock - updated) * per_second)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, clock)
+            while len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+            return allowed
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+class RedisTokenBuckets(object):
+    """Token buckets by key in Redis, shared by every worker."""
+
+    # Refills and takes atomically, by Redis's clock.  Idle buckets expire
+    # once they'd be full again.
+    TAKE = '''
+        redis.replicate_commands()
+        local per_second, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+        local time = redis.call('TIME')
+        local clock = time[1] + time[2] / 1000000
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+        local tokens = tonumber(bucket[1]) or burst
+        local updated = tonumber(bucket[2]) or clock
+        tokens = math.min(burst, tokens + (clock - updated) * per_second)
+        local allowed = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+            allowed = 1
+        end
+        redis.call('HMSET', KEYS[1], 'tokens', tokens, 'updated', clock)
+        redis.call('EXPIRE', KEYS[1], math.ceil(burst / per_second) + 1)
+        return allowed'''
+
+    PREFIX = 'predictions:rate:'
+
+    def __init__(self, client, error):
+        """client is a redis.StrictRedis, error what its failures raise."""
+        self._redis = client
+        self._error = error
+        self._take = self._redis.register_script(self.TAKE)
+
+    def take(self, key, per_second, burst):
+        """Takes a token from key's bucket, or returns False if it's empty.
+
+        If Redis can't be reached, the command is let through: going without
+        limits for a while beats turning every command away.
+        """
+        try:
+            return self._take(keys=[self.PREFIX + key],
+                              args=[per_second, burst]) == 1
+        except self._error:
+            app.logger.exception('rate limiter failed, allowing %s', key)
+            return True
+
+    def clear(self):
+        """Empties every bucket, for every worker."""
+        # The list command shadows the builtin list() in this module.
+        keys = [key for key in self._redis.scan_iter(match=self.PREFIX + '*')]
+        if keys:
+            self._redis.delete(*keys)
+
+if app.config['RATE_LIMIT_REDIS_URL']:
+    # Only needed with this backend, so not in requirements.txt.
+    import redis
+    rate_limiter = RedisTokenBuckets(
+        redis.StrictRedis.from_url(app.config['RATE_LIMIT_REDIS_URL']),
+        redis.RedisError)
+else:
+    rate_limiter = TokenBuckets(int(os.environ.get('RATE_LIMIT_SIZE', 10000)))
+
+def rate_limited(form):
+    """Whether this command goes over the user's or the channel's limit."""
+    for prefix, key in [('USER', 'user:%s' % form['user_name']),
+                        ('CHANNEL', 'channel:%s' % form.get('channel_id'))]:
+        per_minute = app.config[prefix + '_RATE_PER_MINUTE']
+        if (per_minute and (prefix == 'USER' or form.get('channel_id')) and
+                not rate_limiter.take(key, per_minute / 60,
+                                      app.config[prefix + '_RATE_BURST'])):
+            return True
+    return False
+
+def request_key(form):
+    """Identifies a command across Slack's retries of it.
+
+    Slash commands carry a trigger_id that retries repeat.  Without one, the
+    same text from the same user in the same channel within
+    DEDUPE_WINDOW_SECONDS is taken to be a retry.
+    """
+    if form.get('trigger_id'):
+        return 'trigger:%s' % form['trigger_id']
+    window = int(time.time() // app.config['DEDUPE_WINDOW_SECONDS'])
+    return 'text:%s' % hashlib.sha1(json.dumps([
+        form['user_name'], form.get('channel_id'), form['text'],
+        window]).encode('utf-8')).hexdigest()
+
+def run_command_once(key, pending, user_name, text):
+    try:
+        message = run_command(user_name, text)
+    except Exception:
+        # Let a retry run it again.
+        recent_responses.forget(key)
+        pending.finish(None)
+        raise
+    pending.finish(message)
+    return message
+
+def run_deferred_command(response_url, key, pending, user_name, text):
+    try:
+        with app.app_context():
+            message = run_command_once(key, pending, user_name, text)
+    except Exception:
+        app.logger.exception('command failed: %s', text)
+        message = dict(response_type='ephemeral',
+                       text='Error: something went wrong running that')
+    post_to_response_url(response_url, message)
+
+def json_response(message):
+    return Response(json.dumps(message), mimetype='application/json')
+
+@app.route('/health')
+def health():
+    # For load balancers and uptime checks: doesn't touch the database.
+    return 'ok'
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(),
+                    mimetype='text/plain; version=0.0.4')
+
 @app.route('/', methods=['POST'])
 def handle_request():
     if request.form['token'] != os.environ['SLACK_TOKEN']:
         raise Exception('invalid token')
 
-    args = shlex.split(request.form['text'])
+    user_name, text = request.form['user_name'], request.form['text']
+    response_url = request.form.get('response_url')
+    deferred = app.config['DEFERRED_RESPONSES'] and response_url
+    key = request_key(request.form)
+    pending, first = recent_responses.claim(key)
+    if not first:
+        if deferred:
+            # The first attempt will post the reply to the response_url.
+            return json_response(dict(response_type='in_channel'))
+        message = pending.wait(timeout=2.5)
+        if message is None:
+            message = dict(response_type='ephemeral',
+                           text='Still working on that, or it failed; '
+                           'try again in a moment.')
+        return json_response(message)
+
     try:
-        session = db.session
-        user = lookup_or_create_user(session, request.form['user_name'])
-        internal_args = [session, user]
-        command_str = 'predict'
-        if args[0] in commands:
-            command_str = args[0]
-            args = args[1:]
-        selected_command = commands[command_str]
-
-        expected_args = [x for x in inspect.signature(
-            selected_command).parameters][len(internal_args):]
-
-        if len(args) != len(expected_args):
-            raise PredictionsError('usage is %s %s' % (
-                command_str, ' '.join(
-                    '<%s>' % arg for arg in expected_args)))
-
-        response = selected_command(*internal_args, *args)
-        session.commit()
-    except Exception as e:
-        session.rollback()
-        if isinstance(e, PredictionsError):
-            return 'Error: %s' % str(e)
-        else:
-            raise
-    finally:
-        session.close()
+        # Before any database work, so a flood of commands costs next to
+        # nothing.
+        if rate_limited(request.form):
+            message = dict(response_type='ephemeral',
+                           text='Error: too many commands, slow down a little')
+            # Answer concurrent retries the same way, but let later ones run.
+            pending.finish(message)
+            recent_responses.forget(key)
+            return json_response(message)
+
+        if deferred:
+            if worker_pool.submit(run_deferred_command, response_url, key,
+                                  pending, user_name, text):
+                # Slack echoes the command into the channel; the reply
+                # follows.
+                return json_response(dict(response_type='in_channel'))
+            # The queue is full.  Answering inline slows down how fast this
+            # worker takes new requests, which is the backpressure we want.
+    except Exception:
+        # Let a retry run it again.
+        recent_responses.forget(key)
+        pending.finish(None)
+        raise
 
-    return Response(json.dumps(
-        dict(response_type='in_channel', text=response)),
-                    mimetype='application/json')
+    return json_response(run_command_once(key, pending, user_name, text))
 
 if __name__ == '__main__':
+     # Development server only; production runs under gunicorn (see Procfile).
      app.debug = True
-     db.create_all()
      port = int(os.environ.get("PORT", 5000))
      app.run(host='0.0.0.0', port=port)
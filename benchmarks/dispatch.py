@@ -0,0 +1,69 @@
+"""Micro-benchmark of per-request command dispatch overhead.
+
+Compares the dispatch handle_request used to do, which called
+inspect.signature on every request to check arity and build the usage
+string, with the lookup of the precomputed CommandSpec.  Neither touches the
+database.
+
+    python benchmarks/dispatch.py [iterations]
+"""
+
+import os
+import sys
+import timeit
+import inspect
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import app
+
+def dispatch_before(text_args):
+    args = list(text_args)
+    command_str = 'predict'
+    if args and args[0] in app.commands:
+        command_str = args[0]
+        args = args[1:]
+    selected_command = app.commands[command_str].fn
+
+    parameters = [p for p in inspect.signature(
+        selected_command).parameters.values()][len(app.INTERNAL_ARGS):]
+    # Commands like list and batch take *args, which any number can fill.
+    varargs = [p for p in parameters
+               if p.kind == inspect.Parameter.VAR_POSITIONAL]
+    parameters = [p for p in parameters if p not in varargs]
+    required_args = [p for p in parameters
+                     if p.default is inspect.Parameter.empty]
+    max_args = float('inf') if varargs else len(parameters)
+    if not len(required_args) <= len(args) <= max_args:
+        raise app.PredictionsError('usage is %s %s' % (
+            command_str, ' '.join(
+                ('<%s>' if p in required_args else '[<%s>]') % p.name
+                for p in parameters)))
+    return selected_command, args
+
+def dispatch_after(text_args):
+    args = list(text_args)
+    spec = app.commands['predict']
+    if args and args[0] in app.commands:
+        spec = app.commands[args[0]]
+        args = args[1:]
+    if not spec.min_args <= len(args) <= spec.max_args:
+        raise app.PredictionsError(spec.usage)
+    return spec.fn, args
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print('%-16s %12s %12s %8s' % ('command', 'before (us)', 'after (us)',
+                                   'speedup'))
+    for name, spec in sorted(app.commands.items()):
+        text_args = [name] + ['x'] * spec.min_args
+        if name == 'predict':
+            text_args = text_args[1:]
+        before, after = [
+            min(timeit.repeat(lambda: fn(text_args), number=iterations,
+                              repeat=3)) / iterations * 1e6
+            for fn in [dispatch_before, dispatch_after]]
+        print('%-16s %12.2f %12.2f %7.1fx' % (name, before, after,
+                                             before / after))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+"""Load test that replays a trace of slash commands against handle_request.
+
+A trace is a JSONL file with one form post per line: {"user_name": ...,
+"text": ...}.  Generate one with a given mix of commands, then replay it
+either in-process through the Flask test client (which also counts SQL
+statements per command) or against a running server:
+
+    createdb predictionsbench
+    export DATABASE_URL=postgres:///predictionsbench
+    python benchmarks/replay.py generate trace.jsonl --commands 20000
+    python benchmarks/replay.py run trace.jsonl --output before.json
+
+Replay against a fresh database each time, since a trace creates its
+contracts by name.  With --concurrency above 1 the trace is split across
+threads, so some commands will fail, e.g. a predict that now runs before its
+create.  Results are written as JSON so two runs can be diffed.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+import threading
+import subprocess
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from sqlalchemy.engine import Engine
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import app
+
+DEFAULT_MIX = 'create=5,predict=60,show=20,list=10,resolve=5'
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(','):
+        name, weight = part.split('=')
+        weights[name.strip()] = float(weight)
+    unknown = set(weights) - {'create', 'predict', 'show', 'list', 'resolve'}
+    if unknown:
+        raise SystemExit('unknown commands in mix: %s' % ', '.join(unknown))
+    return weights
+
+def generate(args):
+    rng = random.Random(args.seed)
+    weights = parse_mix(args.mix)
+    names, weights = zip(*sorted(weights.items()))
+    users = ['%s-user%d' % (args.prefix, i) for i in range(args.users)]
+    open_contracts = []
+    creators = {}
+    created = 0
+
+    def create():
+        nonlocal created
+        name = '%s-contract%d' % (args.prefix, created)
+        created += 1
+        creators[name] = rng.choice(users)
+        open_contracts.append(name)
+        return creators[name], 'create %s "will %s happen?" "30 days" %.2f' % (
+            name, name, rng.uniform(.05, .95))
+
+    with open(args.trace, 'w') as f:
+        for _ in range(args.commands):
+            kind = rng.choices(names, weights)[0]
+            if kind != 'list' and not open_contracts:
+                kind = 'create'
+            if kind == 'create':
+                user_name, text = create()
+            elif kind == 'predict':
+                user_name = rng.choice(users)
+                text = '%s %.2f' % (rng.choice(open_contracts),
+                                    rng.uniform(.01, .99))
+            elif kind == 'show':
+                user_name = rng.choice(users)
+                text = 'show %s' % rng.choice(
+                    open_contracts + list(creators)[-100:])
+            elif kind == 'list':
+                user_name = rng.choice(users)
+                text = 'list'
+            elif kind == 'resolve':
+                name = open_contracts.pop(rng.randrange(len(open_contracts)))
+                user_name = creators[name]
+                text = 'resolve %s %s' % (name, rng.choice(['true', 'false']))
+            f.write(json.dumps(dict(user_name=user_name, text=text)) + '\n')
+    print('wrote %d commands over %d contracts to %s' % (
+        args.commands, created, args.trace))
+
+# Statements executed by the current thread, for in-process runs.
+query_counts = threading.local()
+
+@app.db.event.listens_for(Engine, 'before_cursor_execute')
+def count_query(*args):
+    query_counts.n = getattr(query_counts, 'n', 0) + 1
+
+def command_name(text):
+    words = text.split(None, 1)
+    if words and words[0] in app.commands:
+        return words[0]
+    return 'predict'
+
+def replay(posts, url, token, results):
+    """Replays posts, appending (command, seconds, queries, ok) to results."""
+    client = None if url else app.app.test_client()
+    for i, post in enumerate(posts):
+        # A distinct trigger_id so repeats aren't answered as Slack retries.
+        form = dict(post, token=token, trigger_id='replay-%d-%d' % (
+            threading.get_ident(), i))
+        query_counts.n = 0
+        start = time.perf_counter()
+        if client:
+            response = client.post('/', data=form)
+            status, body = response.status_code, response.get_data()
+        else:
+            try:
+                with urllib.request.urlopen(url, urllib.parse.urlencode(
+                        form).encode('utf-8')) as response:
+                    status, body = response.status, response.read()
+            except urllib.error.HTTPError as e:
+                status, body = e.code, e.read()
+        elapsed = time.perf_counter() - start
+        ok = status == 200 and not json.loads(body.decode('utf-8')).get(
+            'text', '').startswith('Error:')
+        results.append((command_name(post['text']), elapsed,
+                        None if url else query_counts.n, ok))
+
+def percentile(sorted_values, p):
+    # Nearest-rank percentile.
+    index = max(0, int(round(p / 100 * len(sorted_values))) - 1)
+    return sorted_values[index]
+
+def summarize(results, wall_seconds):
+    def stats(rows):
+        latencies = sorted(elapsed for _, elapsed, _, _ in rows)
+        queries = [n for _, _, n, _ in rows if n is not None]
+        return dict(
+            count=len(rows),
+            errors=len([ok for _, _, _, ok in rows if not ok]),
+            mean_ms=1000 * sum(latencies) / len(latencies),
+            p50_ms=1000 * percentile(latencies, 50),
+            p95_ms=1000 * percentile(latencies, 95),
+            p99_ms=1000 * percentile(latencies, 99),
+            queries_mean=sum(queries) / len(queries) if queries else None)
+
+    by_command = defaultdict(list)
+    for row in results:
+        by_command[row[0]].append(row)
+    overall = stats(results)
+    overall['throughput_per_s'] = len(results) / wall_seconds
+    return overall, {name: stats(rows)
+                     for name, rows in sorted(by_command.items())}
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    with open(args.trace) as f:
+        posts = [json.loads(line) for line in f if line.strip()]
+    if not args.url:
+        os.environ['SLACK_TOKEN'] = args.token
+        # A trace's users fire commands far faster than people do.
+        app.app.config['USER_RATE_PER_MINUTE'] = 0
+        app.app.config['CHANNEL_RATE_PER_MINUTE'] = 0
+        app.migrate()
+
+    # Each thread replays an interleaved slice of the trace.
+    results = []
+    threads = [threading.Thread(target=replay, args=(
+        posts[i::args.concurrency], args.url, args.token, results))
+               for i in range(args.concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    overall, by_command = summarize(results, time.perf_counter() - start)
+
+    print('%-16s %7s %6s %9s %9s %9s %9s' % (
+        'command', 'count', 'errors', 'p50 ms', 'p95 ms', 'p99 ms',
+        'queries'))
+    for name, row in sorted(by_command.items()) + [('all', overall)]:
+        print('%-16s %7d %6d %9.2f %9.2f %9.2f %9s' % (
+            name, row['count'], row['errors'], row['p50_ms'], row['p95_ms'],
+            row['p99_ms'], '-' if row['queries_mean'] is None
+            else '%.1f' % row['queries_mean']))
+    print('throughput: %.1f commands/s' % overall['throughput_per_s'])
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(
+                trace=args.trace, url=args.url,
+                concurrency=args.concurrency, revision=git_revision(),
+                when=datetime.datetime.utcnow().isoformat(),
+                overall=overall, commands=by_command), f, indent=2,
+                      sort_keys=True)
+        print('wrote %s' % args.output)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    subparsers = parser.add_subparsers(dest='action')
+    subparsers.required = True
+
+    p = subparsers.add_parser('generate', help='write a synthetic trace')
+    p.add_argument('trace')
+    p.add_argument('--commands', type=int, default=10000)
+    p.add_argument('--users', type=int, default=50)
+    p.add_argument('--mix', default=DEFAULT_MIX,
+                   help='relative weights, default %s' % DEFAULT_MIX)
+    p.add_argument('--prefix', default='bench',
+                   help='prefix for generated user and contract names')
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(fn=generate)
+
+    p = subparsers.add_parser('run', help='replay a trace')
+    p.add_argument('trace')
+    p.add_argument('--url', help='post to a running server instead of '
+                   'calling the app in-process (no query counts then)')
+    p.add_argument('--token', default=os.environ.get('SLACK_TOKEN', 'bench'))
+    p.add_argument('--concurrency', type=int, default=1)
+    p.add_argument('--output', help='write results as JSON to this file')
+    p.set_defaults(fn=run)
+
+    args = parser.parse_args()
+    args.fn(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""Measures cold start: importing app.py, then answering the first commands.
+
+Each run is a fresh Python process, as after a dyno wakes up.  It times the
+import of app, then the first help (the first request, and the first
+database connection), then the first create (which loads the date parser),
+each through handle_request via the Flask test client.
+
+    python benchmarks/startup.py [--runs 10] [--output startup.json]
+
+With no DATABASE_URL this uses an in-memory SQLite database.  Its schema is
+created between the import and the first request and isn't timed, as
+production creates it with flask migrate before starting.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+PHASES = ['import_ms', 'first_help_ms', 'first_create_ms']
+
+def child():
+    start = time.perf_counter()
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+    import app
+    imported = time.perf_counter()
+    loaded = sorted(name for name in ['parsedatetime', 'pytz', 'tzlocal',
+                                      'numpy'] if name in sys.modules)
+
+    app.migrate()
+    os.environ['SLACK_TOKEN'] = 'startup'
+    client = app.app.test_client()
+    def post(text):
+        started = time.perf_counter()
+        response = client.post('/', data=dict(
+            token='startup', user_name='startup', text=text,
+            trigger_id=text))
+        assert response.status_code == 200, response.get_data()
+        return time.perf_counter() - started
+
+    help_seconds = post('help')
+    create_seconds = post('create startup-%d terms "1 day" .5' % os.getpid())
+    print(json.dumps(dict(
+        import_ms=1000 * (imported - start),
+        first_help_ms=1000 * help_seconds,
+        first_create_ms=1000 * create_seconds,
+        loaded_at_import=loaded)))
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--child', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child()
+
+    env = dict(os.environ)
+    env.setdefault('DATABASE_URL', 'sqlite://')
+    runs = []
+    for _ in range(args.runs):
+        output = subprocess.check_output(
+            [sys.executable, os.path.abspath(__file__), '--child'], env=env)
+        runs.append(json.loads(output.decode('utf-8').splitlines()[-1]))
+
+    results = {phase: dict(median=median([run[phase] for run in runs]),
+                           max=max(run[phase] for run in runs))
+               for phase in PHASES}
+    print('%-16s %9s %9s' % ('phase', 'median ms', 'max ms'))
+    for phase in PHASES:
+        print('%-16s %9.1f %9.1f' % (phase[:-3], results[phase]['median'],
+                                     results[phase]['max']))
+    print('loaded at import: %s' % (
+        ', '.join(runs[0]['loaded_at_import']) or 'none of the lazy modules'))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(runs=runs, results=results,
+                           database=env['DATABASE_URL']), f, indent=2,
+                      sort_keys=True)
+        print('wrote %s' % args.output)
+
+if __name__ == '__main__':
+    main()
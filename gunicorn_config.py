@@ -0,0 +1,21 @@
+# Production server settings for gunicorn.  See the Procfile.
+
+import os
+
+bind = '0.0.0.0:%s' % os.environ.get('PORT', 5000)
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+timeout = 30
+
+# Import the app once in the master so workers fork with it already loaded.
+preload_app = True
+
+def post_fork(server, worker):
+    # Connections must not be shared across processes.  Nothing should have
+    # connected before the fork, but make sure each worker starts with an
+    # empty pool.
+    from app import app, db, read_session
+    db.engine.dispose()
+    if read_session is not None:
+        db.get_engine(app, bind='read').dispose()
@@ -4,44 +4,68 @@ To run tests:
 
     pytest .
 
-These tests depend on a postgres db.  Either you can specify the URL of an
-empty db with TEST_DATABASE_URL, or you can let this script delete (if exists)
-and create a db called postgres:///predictionstest.
+By default these run against an in-memory SQLite database.  To run them
+against postgres as well, give the URL of a database with TEST_DATABASE_URL:
+it's migrated to the latest schema, and every test's changes are rolled back.
+The Redis rate limiter's script runs against the Redis server at
+TEST_REDIS_URL, if given.
 """
 
 import os
+import re
+import json
 import pytest
+import fnmatch
 import datetime
-import subprocess
+import threading
+import http.server
+import sqlalchemy
 
 HOUR = datetime.timedelta(seconds=3600)
 
 assert 'DATABASE_URL' not in os.environ
-
-if 'TEST_DATABASE_URL' in os.environ:
-    os.environ['DATABASE_URL'] = os.environ['TEST_DATABASE_URL']
-else:
-    # No db supplied, make our own.  Drop and recreate.
-    _localdb = 'predictionstest'
-    command = ['dropdb', _localdb]
-    pipes = subprocess.Popen(command, stderr=subprocess.PIPE)
-    stdout, stderr = pipes.communicate()
-    if pipes.returncode != 0 and b'does not exist' not in stderr:
-        raise Exception('"%s" failed with stderr=%s' % (
-            ' '.join(command), stderr.strip()))
-    subprocess.check_call(['createdb', _localdb])
-
-    os.environ['DATABASE_URL'] = 'postgres:///%s' % _localdb
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL', 'sqlite://')
 
 import app
 db = app.db
-db.create_all()
+app.migrate()
 
 @pytest.fixture
-def s():
-    yield db.session
-    db.session.rollback()
-    db.session.close()
+def s(monkeypatch):
+    # Cached entries would outlive the rows we roll back after each test.
+    app.user_cache.clear()
+    app.show_cache.clear()
+    app.recent_responses.clear()
+    app.search_index.clear()
+    app.rate_limiter.clear()
+
+    # Run each test in a transaction that's rolled back at the end.  Commits
+    # and rollbacks inside it release or roll back a savepoint, which is then
+    # restarted.  All threads share the session, so that requests handled in
+    # the background see the test's rows.
+    connection = db.engine.connect()
+    transaction = connection.begin()
+    session = db.create_scoped_session(options=dict(
+        bind=connection, binds={}, scopefunc=lambda: None))
+    session.begin_nested()
+
+    def restart_savepoint(session, transaction):
+        if transaction.nested and not transaction.parent.nested:
+            session.expire_all()
+            session.begin_nested()
+    sqlalchemy.event.listen(session, 'after_transaction_end',
+                            restart_savepoint)
+    # The end of a request closes the session, which would otherwise leave
+    # its uncommitted changes in the savepoint.
+    monkeypatch.setattr(session(), 'close', session.rollback)
+    monkeypatch.setattr(session, 'remove', session.rollback)
+    monkeypatch.setattr(db, 'session', session)
+
+    yield session
+    sqlalchemy.event.remove(session, 'after_transaction_end',
+                            restart_savepoint)
+    transaction.rollback()
+    connection.close()
 
 def run(s, command, *args):
     try:
@@ -101,8 +125,8 @@ def test_list(s):
     run(s, app.resolve, 'test-contract6', 'false')
 
     assert '''\
-test-contract1
-test-contract2''' == run(s, app.list)
+test-contract1   50.00% (1 prediction)
+test-contract2   50.00% (1 prediction)''' == run(s, app.list)
 
     assert '''\
 test-contract3
@@ -120,11 +144,14 @@ def test_list(s):
     run(s, app.create, 'test-contract2', 'terms', '1 hour', '.5')
     run(s, app.create, 'test-contract3', 'terms', '1 hour', '.5')
 
+    run(s, app.predict, 'test-contract2', '.6')
+    run(s, app.predict, 'test-contract2', '70%')
+
     out = run(s, app.list)
     assert '''\
-test-contract1
-test-contract2
-test-contract3''' == out
+test-contract1   50.00% (1 prediction)
+test-contract2   70.00% (3 predictions)
+test-contract3   50.00% (1 prediction)''' == out
 
 def test_predict(s):
     run_error(s, 'unknown contract',
@@ -138,6 +165,16 @@ def test_predict(s):
 
     run(s, app.predict, 'test-contract2', '60%')
 
+    # A predict that lands after a newer one doesn't move the price back.
+    contract = app.get_contract_or_raise(s, 'test-contract2')
+    later = app.now() + HOUR
+    contract.when_last_predicted = later
+    s.flush()
+    run(s, app.predict, 'test-contract2', '.2')
+    s.refresh(contract)
+    assert (contract.last_value, contract.prediction_count) == (.6, 3)
+    assert contract.when_last_predicted == later
+
     run(s, app.resolve, 'test-contract1', 'false')
 
     run_error(s, 'already resolved',
@@ -247,3 +284,768 @@ def test_dt_to_string():
         app.now() + datetime.timedelta(seconds=60*34+5)) == '34min from now'
     assert app.dt_to_string(
         app.now() - datetime.timedelta(seconds=60*34+5)) == '34min ago'
+
+def test_score_ledger(s):
+    run(s, app.create, 'test-contract1', 'terms', '1 hour', '.5')
+    user1 = app.lookup_or_create_user(s, 'user1')
+    app.predict(s, user1, 'test-contract1', '.8')
+    contract = app.get_contract_or_raise(s, 'test-contract1')
+    assert s.query(app.Score).count() == 0
+
+    run(s, app.resolve, 'test-contract1', 'true')
+    scores = s.query(app.Score).filter(
+        app.Score.contract_id == contract.contract_id).all()
+    assert [(score.user_id, round(score.points, 2)) for score in scores] == [
+        (user1.user_id, 47.0)]
+
+    app.rescore_all(s)
+    assert s.query(app.Score).count() == 1
+
+    run(s, app.cancel, 'test-contract1')
+    assert s.query(app.Score).count() == 0
+
+def test_mine(s):
+    assert run(s, app.mine) == 'you have no predictions on active contracts'
+
+    run(s, app.create, 'test-contract1', 'terms', '2 hours', '.5')
+    run(s, app.create, 'test-contract2', 'terms', '1 hour', '.4')
+    run(s, app.create, 'test-contract3', 'terms', '1 hour', '.3')
+    user1 = app.lookup_or_create_user(s, 'user1')
+    app.predict(s, user1, 'test-contract1', '.6')
+    app.predict(s, user1, 'test-contract1', '.7')
+    app.predict(s, user1, 'test-contract2', '.2')
+    app.predict(s, user1, 'test-contract3', '.9')
+    test = app.lookup_or_create_user(s, 'test')
+    app.predict(s, test, 'test-contract1', '.8')
+    run(s, app.resolve, 'test-contract3', 'true')
+
+    assert app.mine(s, user1) == """\
+test-contract2   you 20.00%, now 20.00% (closes 59min from now)
+test-contract1   you 70.00%, now 80.00% (closes 1hr from now)"""
+    assert run(s, app.mine).startswith('test-contract2   you 40.00%')
+
+def test_search(s):
+    run_error(s, 'usage is search <words> ...', app.search)
+    assert run(s, app.search, 'rain') == 'no contracts match rain'
+
+    run(s, app.create, 'rain-tomorrow', 'Will it rain in London tomorrow?',
+        '1 day', '.5')
+    run(s, app.create, 'launch', 'Will we launch on time, rain or shine? ' +
+        'x' * 40, '1 day', '.5')
+    run(s, app.create, 'sunny', 'Sunshine all week', '1 day', '.5')
+
+    assert run(s, app.search, 'rain', 'london') == """\
+rain-tomorrow   Will it rain in London tomorrow?
+launch   Will we launch on time, rain or shine? xxxxxxxxxxxxxxxxxx..."""
+    assert run(s, app.search, 'sun') == 'sunny   Sunshine all week'
+
+    # Contracts created since the last search are found too.
+    run(s, app.create, 'snow', 'Will it snow?', '1 day', '.5')
+    assert run(s, app.search, 'SNOW').startswith('snow   ')
+
+    run_error(s, 'unknown contract rain-lon (did you mean rain-tomorrow, '
+              'launch?)', app.show, 'rain-lon')
+    run_error(s, 'unknown contract nothing-like-it', app.show,
+              'nothing-like-it')
+
+def test_leaderboard(s):
+    assert 'no resolved contracts' in run(s, app.leaderboard)
+
+    user1 = app.lookup_or_create_user(s, 'user1')
+    user2 = app.lookup_or_create_user(s, 'user2')
+    for name in ['test-contract1', 'test-contract2', 'test-contract3']:
+        run(s, app.create, name, 'terms', '1 hour', '.5')
+        app.predict(s, user1, name, '.8')
+        app.predict(s, user2, name, '.4')
+    run(s, app.resolve, 'test-contract1', 'true')
+    run(s, app.resolve, 'test-contract2', 'false')
+    run(s, app.resolve, 'test-contract3', 'false')
+
+    assert run(s, app.leaderboard) == '''\
+leaderboard:
+-------
+1. user2: 150.41
+2. user1: -136.26'''
+
+    # Cancelling takes the points back out of the totals.
+    run(s, app.cancel, 'test-contract3')
+    assert run(s, app.leaderboard) == '''\
+leaderboard:
+-------
+1. user2: 40.55
+2. user1: -44.63'''
+
+    contract1 = app.get_contract_or_raise(s, 'test-contract1')
+    s.query(app.Score).filter(
+        app.Score.contract_id == contract1.contract_id).update({
+            app.Score.when_resolved: app.now() - 30*24*HOUR})
+    assert run(s, app.leaderboard, '7') == '''\
+leaderboard (last 7 days):
+-------
+1. user2: 109.86
+2. user1: -91.63'''
+
+    for days in ['week', 'inf', '1e10', 'nan', '-1', '0']:
+        run_error(s, '%s is not a valid number of days' % days,
+                  app.leaderboard, days)
+
+def count_queries(s, fn, *args):
+    queries = []
+    def before_cursor_execute(*args):
+        queries.append(args)
+    engine = s.get_bind()
+    sqlalchemy.event.listen(
+        engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        fn(*args)
+    finally:
+        sqlalchemy.event.remove(
+            engine, 'before_cursor_execute', before_cursor_execute)
+    return len(queries)
+
+def test_show_query_count(s):
+    run(s, app.create, 'test-contract1', 'terms', '1 hour', '.5')
+    contract = app.get_contract_or_raise(s, 'test-contract1')
+    users = [app.lookup_or_create_user(s, 'user%d' % i) for i in range(10)]
+    s.flush()
+    user_ids = [user.user_id for user in users]
+
+    def add_predictions(n):
+        s.execute(app.Prediction.__table__.insert(), [
+            dict(value=.5, user_id=user_ids[i % 10],
+                 contract_id=contract.contract_id, when_created=app.now())
+            for i in range(n)])
+
+    # The raw inserts don't bump the contract's version, so skip the cache.
+    add_predictions(10)
+    app.show_cache.clear()
+    few = count_queries(s, run, s, app.show, 'test-contract1')
+    add_predictions(10000 - 10)
+    app.show_cache.clear()
+    many = count_queries(s, run, s, app.show, 'test-contract1')
+    assert few == many
+    assert many <= 4
+
+BASELINE_SCHEMA = [
+    '''CREATE TABLE "user" (
+           user_id INTEGER PRIMARY KEY,
+           slack_id TEXT NOT NULL UNIQUE)''',
+    '''CREATE TABLE contract (
+           contract_id INTEGER PRIMARY KEY,
+           name TEXT NOT NULL UNIQUE,
+           terms TEXT NOT NULL,
+           user_id INTEGER NOT NULL REFERENCES "user" (user_id),
+           when_closes TIMESTAMP NOT NULL,
+           when_created TIMESTAMP NOT NULL,
+           resolution BOOLEAN,
+           when_resolved TIMESTAMP,
+           when_cancelled TIMESTAMP)''',
+    '''CREATE TABLE prediction (
+           prediction_id INTEGER PRIMARY KEY,
+           value FLOAT NOT NULL,
+           user_id INTEGER NOT NULL REFERENCES "user" (user_id),
+           contract_id INTEGER NOT NULL REFERENCES contract (contract_id),
+           when_created TIMESTAMP NOT NULL)''',
+]
+
+def test_migrate(tmpdir):
+    engine = sqlalchemy.create_engine(
+        'sqlite:///%s' % tmpdir.join('baseline.db'))
+    for statement in BASELINE_SCHEMA:
+        engine.execute(statement)
+    when = app.now()
+    engine.execute('INSERT INTO "user" VALUES (1, \'test\'), (2, \'user1\')')
+    engine.execute(
+        'INSERT INTO contract VALUES (1, \'test-contract1\', \'terms\', 1, '
+        '?, ?, 1, ?, NULL)', when, when, when)
+    engine.execute(
+        'INSERT INTO prediction VALUES (1, .5, 1, 1, ?), (2, .8, 2, 1, ?)',
+        when, when + HOUR)
+    engine.execute(
+        'INSERT INTO contract VALUES (2, \'test-contract2\', \'terms\', 1, '
+        '?, ?, NULL, NULL, NULL)', when, when)
+
+    applied = app.migrate(engine)
+    assert len(applied) == len(app.migrations)
+    assert engine.execute(
+        'SELECT max(version) FROM schema_version').scalar() == len(applied)
+    assert engine.execute(
+        'SELECT round(score, 2), scored_contracts FROM "user" '
+        'WHERE user_id = 2').fetchall() == [(47.0, 1)]
+    indexes = set()
+    for table in ['contract', 'prediction']:
+        indexes.update(index['name'] for index in
+                       sqlalchemy.inspect(engine).get_indexes(table))
+    assert {'ix_prediction_contract_id_when_created',
+            'ix_prediction_user_id_contract_id_when_created',
+            'ix_contract_when_closes', 'ix_contract_resolution',
+            'ix_contract_when_cancelled'} <= indexes
+
+    assert engine.execute(
+        'SELECT name, last_value, prediction_count FROM contract '
+        'ORDER BY name').fetchall() == [
+            ('test-contract1', .8, 2), ('test-contract2', None, 0)]
+
+    assert app.migrate(engine) == []
+
+    # A fresh database is created from the models at the latest version.
+    engine = sqlalchemy.create_engine('sqlite:///%s' % tmpdir.join('new.db'))
+    assert app.migrate(engine) == []
+    assert engine.execute(
+        'SELECT max(version) FROM schema_version').scalar() == len(
+            app.migrations)
+
+def post_message(text, user_name='test', **form):
+    os.environ['SLACK_TOKEN'] = 'token'
+    with app.app.test_client() as client:
+        response = client.post('/', data=dict(
+            token='token', user_name=user_name, text=text, **form))
+    assert response.status_code == 200
+    return json.loads(response.get_data(as_text=True))
+
+def post(text, user_name='test'):
+    return post_message(text, user_name)['text']
+
+def test_handle_request(s):
+    assert app.commands['show'].usage == (
+        'usage is show <contract_name> [summary|full]')
+    assert app.commands['leaderboard'].usage == 'usage is leaderboard [<days>]'
+    assert 'Error: usage is show <contract_name> [summary|full]' == post(
+        'show')
+    assert 'Error: usage is predict <contract_name> <percentage>' == post(
+        'test-contract1')
+    assert 'Error: unknown contract test-contract1' == post(
+        'show test-contract1')
+
+    # Read-only commands don't write, so a first-time user who only reads
+    # isn't created yet.
+    assert '/predict more_help' in post('help', user_name='reader')
+    assert app.db.session.query(app.User).filter(
+        app.User.slack_id == 'reader').one_or_none() is None
+
+def test_lru_cache():
+    cache = app.LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+    assert (cache.hits, cache.misses) == (3, 1)
+    assert cache.hit_rate == .75
+
+    cache = app.LRUCache(10, weigh=len)
+    cache.put('a', 'x' * 6)
+    cache.put('b', 'x' * 3)
+    cache.put('c', 'x' * 11)
+    assert cache.get('c') is None
+    cache.put('c', 'x' * 2)
+    assert cache.size == 5
+    assert cache.get('a') is None
+
+def test_lookup_or_create_user(s):
+    # As if another request had created and committed user1.
+    s.execute(app.User.__table__.insert(), dict(slack_id='user1'))
+    user = app.lookup_or_create_user(s, 'user1')
+    assert app.user_cache.misses == 1
+    assert count_queries(s, app.lookup_or_create_user, s, 'user1') == 0
+    assert app.lookup_or_create_user(s, 'user1') is user
+    assert app.user_cache.hits == 2
+
+    # Users created in this transaction aren't cached until it's over.
+    user2 = app.lookup_or_create_user(s, 'user2')
+    assert app.lookup_or_create_user(s, 'user2') is user2
+    assert len(app.user_cache) == 1
+
+    # Lose the race to create a user: the insert hits the unique constraint
+    # and we pick up the other request's row instead.
+    s.execute(app.User.__table__.insert(), dict(slack_id='user3'))
+    user3 = app.create_user(s, 'user3')
+    assert user3.user_id is not None
+    assert app.lookup_or_create_user(s, 'user3') is user3
+
+class SlackStub(http.server.BaseHTTPRequestHandler):
+    """Stands in for Slack's response_url endpoint."""
+
+    received = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        SlackStub.received.append(json.loads(body.decode('utf-8')))
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def slack_stub():
+    SlackStub.received = []
+    server = http.server.HTTPServer(('127.0.0.1', 0), SlackStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield 'http://127.0.0.1:%d/response' % server.server_port
+    server.shutdown()
+    server.server_close()
+
+def test_deferred_responses(s, slack_stub, monkeypatch):
+    # One thread, since the background requests share the test's session.
+    monkeypatch.setattr(app, 'worker_pool', app.WorkerPool(1, 10))
+    app.app.config['DEFERRED_RESPONSES'] = True
+    try:
+        assert post_message('help', response_url=slack_stub) == dict(
+            response_type='in_channel')
+        assert post_message('show nope', response_url=slack_stub) == dict(
+            response_type='in_channel')
+        app.worker_pool.join()
+    finally:
+        app.app.config['DEFERRED_RESPONSES'] = False
+
+    error_message, help_message = sorted(
+        SlackStub.received, key=lambda message: message['response_type'])
+    assert error_message == dict(response_type='ephemeral',
+                                 text='Error: unknown contract nope')
+    assert help_message['response_type'] == 'in_channel'
+    assert '/predict more_help' in help_message['text']
+
+def test_worker_pool_backpressure():
+    pool = app.WorkerPool(threads=1, max_queued=1)
+    started, release = threading.Event(), threading.Event()
+    def block():
+        started.set()
+        release.wait()
+    assert pool.submit(block)
+    started.wait()
+    assert pool.submit(block)
+    assert not pool.submit(block)
+    release.set()
+    pool.join()
+    assert pool.submit(block)
+    pool.join()
+
+def test_retries_run_once(s, monkeypatch):
+    calls = []
+    release = threading.Event()
+    def slow_help(*args):
+        calls.append(args)
+        release.wait()
+        return 'helped'
+    monkeypatch.setattr(app.commands['help'], 'fn', slow_help)
+
+    replies = []
+    threads = [threading.Thread(target=lambda: replies.append(
+        post_message('help', trigger_id='t1'))) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert [reply['text'] for reply in replies] == ['helped'] * 3
+
+    # Without a trigger_id, the same text from the same user and channel
+    # is a retry; from another channel it isn't.
+    assert post('help', user_name='a') == 'helped'
+    assert post_message('help', user_name='a')['text'] == 'helped'
+    assert len(calls) == 2
+    post_message('help', user_name='a', channel_id='elsewhere')
+    assert len(calls) == 3
+
+    # A command that failed is run again on retry.
+    def broken_help(*args):
+        calls.append(args)
+        raise Exception('boom')
+    monkeypatch.setattr(app.commands['help'], 'fn', broken_help)
+    with app.app.test_client() as client:
+        for _ in range(2):
+            assert client.post('/', data=dict(
+                token='token', user_name='b', text='help',
+                trigger_id='t2')).status_code == 500
+    assert len(calls) == 5
+
+def test_token_buckets():
+    buckets = app.TokenBuckets(max_size=2)
+    results = []
+    def burst():
+        results.append(buckets.take('a', per_second=.001, burst=5))
+    threads = [threading.Thread(target=burst) for _ in range(50)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results.count(True) == 5
+
+    assert buckets.take('b', per_second=.001, burst=1)
+    assert not buckets.take('b', per_second=.001, burst=1)
+    # Beyond max_size, the least recently used bucket starts over.
+    assert buckets.take('c', per_second=.001, burst=1)
+    assert buckets.take('a', per_second=.001, burst=5)
+    assert buckets.take('b', per_second=.001, burst=1)
+
+    assert buckets.take('d', per_second=1000, burst=1)
+    threading.Event().wait(.01)
+    assert buckets.take('d', per_second=1000, burst=1)
+
+def test_rate_limits(s, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'USER_RATE_PER_MINUTE', .01)
+    monkeypatch.setitem(app.app.config, 'USER_RATE_BURST', 3)
+    monkeypatch.setitem(app.app.config, 'CHANNEL_RATE_PER_MINUTE', .01)
+    monkeypatch.setitem(app.app.config, 'CHANNEL_RATE_BURST', 4)
+    limited = 'Error: too many commands, slow down a little'
+
+    for i in range(3):
+        assert post_message('help', trigger_id=i)['text'] != limited
+    # Turned away without touching the database.
+    replies = []
+    assert count_queries(s, lambda: replies.append(
+        post_message('help', trigger_id=3))) == 0
+    assert replies[0]['text'] == limited
+    assert post_message('help', user_name='user1')['text'] != limited
+
+    # Other users in a busy channel are limited too.
+    for user_name in ['user2', 'user3', 'user4', 'user5']:
+        post_message('help', user_name=user_name, channel_id='busy')
+    assert post_message('help', user_name='user6', channel_id='busy')[
+        'text'] == limited
+
+    # A limiter that fails doesn't leave retries of the command stuck.
+    class BrokenBuckets(object):
+        def take(self, key, per_second, burst):
+            raise Exception('boom')
+    monkeypatch.setattr(app, 'rate_limiter', BrokenBuckets())
+    with app.app.test_client() as client:
+        assert client.post('/', data=dict(
+            token='token', user_name='user7', text='help',
+            trigger_id='t4')).status_code == 500
+    monkeypatch.setattr(app, 'rate_limiter', app.TokenBuckets(10))
+    assert '/predict more_help' in post_message(
+        'help', user_name='user7', trigger_id='t4')['text']
+
+class RedisDown(Exception):
+    pass
+
+class FakeRedis(object):
+    """Enough of redis.StrictRedis for RedisTokenBuckets, without refills."""
+
+    def __init__(self):
+        self.data = {}
+        self.down = False
+
+    def register_script(self, script):
+        def take(keys, args):
+            if self.down:
+                raise RedisDown()
+            tokens = self.data.get(keys[0], args[1])
+            self.data[keys[0]] = max(tokens - 1, 0)
+            return int(tokens >= 1)
+        return take
+
+    def scan_iter(self, match):
+        return [key for key in self.data if fnmatch.fnmatch(key, match)]
+
+    def delete(self, *keys):
+        for key in keys:
+            del self.data[key]
+
+def test_redis_token_buckets():
+    client = FakeRedis()
+    client.data['other'] = 1
+    buckets = app.RedisTokenBuckets(client, RedisDown)
+    assert buckets.take('a', per_second=.001, burst=1)
+    assert not buckets.take('a', per_second=.001, burst=1)
+    assert sorted(client.data) == ['other', 'predictions:rate:a']
+
+    buckets.clear()
+    assert client.data == dict(other=1)
+    assert buckets.take('a', per_second=.001, burst=1)
+
+    # Commands get through while Redis is down.
+    client.down = True
+    assert buckets.take('a', per_second=.001, burst=1)
+
+@pytest.mark.skipif(not os.environ.get('TEST_REDIS_URL'),
+                    reason='needs a Redis server at TEST_REDIS_URL')
+def test_redis_token_buckets_script():
+    redis = pytest.importorskip('redis')
+    buckets = app.RedisTokenBuckets(redis.StrictRedis.from_url(
+        os.environ['TEST_REDIS_URL']), redis.RedisError)
+    buckets.clear()
+    assert [buckets.take('a', per_second=.001, burst=2)
+            for _ in range(3)] == [True, True, False]
+    assert buckets.take('b', per_second=1000, burst=1)
+    threading.Event().wait(.01)
+    assert buckets.take('b', per_second=1000, burst=1)
+    buckets.clear()
+    assert buckets.take('a', per_second=.001, burst=1)
+    buckets.clear()
+
+def test_health():
+    with app.app.test_client() as client:
+        response = client.get('/health')
+    assert response.status_code == 200
+    assert response.get_data(as_text=True) == 'ok'
+
+def test_list_pages(s, monkeypatch):
+    monkeypatch.setattr(app, 'PAGE_SIZE', 2)
+    for i in [3, 1, 2, 4, 5]:
+        run(s, app.create, 'test-contract%d' % i, 'terms', '1 hour', '.5')
+    run(s, app.cancel, 'test-contract5')
+
+    assert run(s, app.list) == '''\
+test-contract1   50.00% (1 prediction)
+test-contract2   50.00% (1 prediction)
+(more: /predict list after test-contract2)'''
+    assert run(s, app.list, 'after', 'test-contract2') == '''\
+test-contract3   50.00% (1 prediction)
+test-contract4   50.00% (1 prediction)'''
+    assert run(s, app.list, 'after', 'test-contract4') == 'no active contracts'
+    assert run(s, app.list_cancelled) == 'test-contract5'
+
+    # As migrated from before predict kept the odds on the contract.
+    test = app.lookup_or_create_user(s, 'test')
+    s.add(app.Contract('test-contract0', 'terms', test.user_id,
+                       app.now() + HOUR))
+    s.flush()
+    assert run(s, app.list).startswith('''\
+test-contract0   no predictions
+test-contract1   50.00% (1 prediction)''')
+
+    run_error(s, 'usage is list [after <contract-name>]',
+              app.list, 'before', 'test-contract2')
+    assert post('list after') == (
+        'Error: usage is list [after <contract-name>]')
+
+def test_show_cache(s):
+    run(s, app.create, 'test-contract1', 'terms', '1 hour', '.5')
+    first = run(s, app.show, 'test-contract1')
+    assert run(s, app.show, 'test-contract1') == first
+    assert (app.show_cache.hits, app.show_cache.misses) == (1, 1)
+    # A hit costs the user lookup and the contract lookup, nothing more.
+    assert count_queries(s, run, s, app.show, 'test-contract1') == 2
+
+    user1 = app.lookup_or_create_user(s, 'user1')
+    app.predict(s, user1, 'test-contract1', '.7')
+    out = run(s, app.show, 'test-contract1')
+    assert '70.00%   user1 (' in out
+    assert app.show_cache.misses == 2
+
+    run(s, app.resolve, 'test-contract1', 'true')
+    assert 'user1: 33.65' in run(s, app.show, 'test-contract1')
+    run(s, app.cancel, 'test-contract1')
+    assert 'scores' not in run(s, app.show, 'test-contract1')
+    assert app.show_cache.misses == 4
+
+def test_show_summary(s, monkeypatch):
+    monkeypatch.setattr(app, 'SUMMARY_RECENT', 2)
+    monkeypatch.setattr(app, 'SUMMARY_BUCKETS', 4)
+    run(s, app.create, 'test-contract1', 'terms', '1 hour', '.5')
+    user1 = app.lookup_or_create_user(s, 'user1')
+    user2 = app.lookup_or_create_user(s, 'user2')
+    app.predict(s, user1, 'test-contract1', '.9')
+    app.predict(s, user2, 'test-contract1', '.1')
+    app.predict(s, user1, 'test-contract1', '.3')
+    # Spread the predictions over four hours, one per history bucket.
+    start = app.now() - datetime.timedelta(hours=4)
+    for i, prediction in enumerate(s.query(app.Prediction).order_by(
+            app.Prediction.prediction_id)):
+        prediction.when_created = start + datetime.timedelta(hours=i)
+    s.flush()
+
+    out = run(s, app.show, 'test-contract1', 'summary')
+    assert '4 predictions, 30.00% now' in out
+    assert 'history: \u2585\u2588\u2581\u2583' in out
+    latest = out.split('latest by user:\n')[1].split('\n\n')[0].split('\n')
+    assert [line.split(' (')[0] for line in latest] == [
+        '30.00%   user1', '10.00%   user2', '50.00%   test']
+    recent = out.split('last 2 predictions:\n')[1].split('\n')
+    assert [line.split(' (')[0] for line in recent] == [
+        '10.00%   user2', '30.00%   user1']
+    assert '90.00%' not in out
+
+    # Past SUMMARY_POSITIONS users, the rest are only counted.
+    for limit, expected in [
+            (3, ['30.00%   user1', '10.00%   user2', '50.00%   test']),
+            (2, ['30.00%   user1', '10.00%   user2', '...and 1 more'])]:
+        monkeypatch.setattr(app, 'SUMMARY_POSITIONS', limit)
+        app.show_cache.clear()
+        out = run(s, app.show, 'test-contract1', 'summary')
+        latest = out.split('latest by user:\n')[1].split('\n\n')[0]
+        assert [line.split(' (')[0] for line in latest.split('\n')] == expected
+
+    run(s, app.resolve, 'test-contract1', 'false')
+    assert 'user1: ' in run(s, app.show, 'test-contract1', 'summary')
+
+    # Big contracts are summarized unless asked for in full.
+    monkeypatch.setattr(app, 'SUMMARY_THRESHOLD', 3)
+    assert 'latest by user:' in run(s, app.show, 'test-contract1')
+    assert '90.00%' in run(s, app.show, 'test-contract1', 'full')
+    run_error(s, 'usage is show', app.show, 'test-contract1', 'brief')
+
+def test_calibration(s):
+    assert run(s, app.calibration) == (
+        'calibration for test: no predictions on resolved contracts')
+
+    user1 = app.lookup_or_create_user(s, 'user1')
+    for i, (value, resolution) in enumerate([
+            ('.15', 'false'), ('.12', 'true'), ('.85', 'true'),
+            ('.9', 'true'), ('.95', 'false')]):
+        name = 'test-contract%d' % i
+        run(s, app.create, name, 'terms', '1 hour', '.5')
+        app.predict(s, user1, name, value)
+        run(s, app.resolve, name, resolution)
+    run(s, app.create, 'test-contract-open', 'terms', '1 hour', '.5')
+    app.predict(s, user1, 'test-contract-open', '.99')
+
+    assert run(s, app.calibration, 'user1') == '''\
+calibration for user1 (5 predictions, Brier score 0.346):
+stated   predictions  observed  Brier
+10-20%             2    50.00%  0.398
+80-90%             1   100.00%  0.023
+90-100%            2    50.00%  0.456'''
+
+    out = run(s, app.calibration, 'team')
+    assert out.startswith('team calibration (10 predictions, ')
+    assert '50-60%             5    60.00%  0.250' in out
+
+    run_error(s, 'unknown user nobody', app.calibration, 'nobody')
+
+def dump_rows(connection):
+    return [connection.execute(table.select().order_by(
+        *table.primary_key.columns)).fetchall()
+            for table in app.DUMP_TABLES + [app.Score.__table__]]
+
+@pytest.mark.parametrize('fmt', ['jsonl', 'csv'])
+def test_export_import(s, tmpdir, fmt):
+    run(s, app.create, 'test-contract1', 'terms, "quoted"\n\\\t', '1 hour',
+        '.5')
+    run(s, app.create, 'test-contract2', '', '1 hour', '.5')
+    user1 = app.lookup_or_create_user(s, 'user1')
+    app.predict(s, user1, 'test-contract1', '.8')
+    run(s, app.resolve, 'test-contract1', 'true')
+    s.flush()
+    before = dump_rows(s.connection())
+
+    counts = app.export_tables(s.connection(), str(tmpdir), fmt)
+    assert counts == dict(user=2, contract=2, prediction=3)
+
+    # Load into an empty SQLite database through batched inserts...
+    engine = sqlalchemy.create_engine('sqlite:///%s' % tmpdir.join('copy.db'))
+    app.migrate(engine)
+    with engine.begin() as connection:
+        assert app.import_tables(connection, str(tmpdir)) == counts
+        assert dump_rows(connection) == before
+
+    # ...and back into this one, through COPY if it's Postgres.
+    for table in reversed(app.DUMP_TABLES + [app.Score.__table__]):
+        s.execute(table.delete())
+    assert app.import_tables(s.connection(), str(tmpdir)) == counts
+    assert dump_rows(s.connection()) == before
+    run(s, app.create, 'test-contract3', 'terms', '1 hour', '.5')
+
+def test_metrics(s, monkeypatch):
+    app.metrics.reset()
+    warnings = []
+    monkeypatch.setitem(app.app.config, 'SLOW_REQUEST_MS', 0)
+    monkeypatch.setattr(app.app.logger, 'warning',
+                        lambda *args: warnings.append(args[0] % args[1:]))
+    post('help')
+    post('show nope')
+    post('show')
+    monkeypatch.setattr(app, 'lookup_or_create_user', None)
+    with app.app.test_client() as client:
+        assert client.post('/', data=dict(
+            token='token', user_name='test', text='list')).status_code == 500
+        response = client.get('/metrics')
+    assert response.mimetype == 'text/plain'
+    out = response.get_data(as_text=True)
+    assert 'predictions_request_seconds_bucket{command="help",le="+Inf"} 1' in (
+        out)
+    assert 'predictions_request_seconds_count{command="show"} 2' in out
+    assert 'predictions_errors_total{command="show",kind="user"} 2' in out
+    assert 'predictions_errors_total{command="list",kind="unexpected"} 1' in (
+        out)
+    statements = re.search(
+        r'^predictions_sql_statements_total\{command="help"\} (\d+)$', out,
+        re.MULTILINE)
+    assert int(statements.group(1)) > 0
+    assert 'predictions_sql_seconds_total{command="help"}' in out
+    assert 'predictions_cache_lookups_total{cache="show",result="miss"}' in out
+
+    assert len(warnings) == 4
+    assert 'show nope' in warnings[1]
+    assert 'FROM contract' in warnings[1]
+
+def test_read_session(s, tmpdir, monkeypatch):
+    engine = sqlalchemy.create_engine('sqlite:///%s' % tmpdir.join('read.db'))
+    app.migrate(engine)
+    engine.execute(app.User.__table__.insert(), dict(slack_id='user1'))
+    engine.execute(app.Contract.__table__.insert(), dict(
+        name='replica-contract', terms='terms', user_id=1,
+        when_closes=app.now() + HOUR, when_created=app.now(), last_value=.5,
+        prediction_count=1))
+    monkeypatch.setattr(app, 'read_session', sqlalchemy.orm.scoped_session(
+        sqlalchemy.orm.sessionmaker(bind=engine)))
+
+    # Readers go to the read database, writers to the primary.
+    assert post('list') == 'replica-contract   50.00% (1 prediction)'
+    assert post('create test-contract1 terms "1 hour" .5').startswith(
+        'Created contract test-contract1')
+    assert s.query(app.Contract.name).all() == [('test-contract1',)]
+    assert 'test-contract1' not in post('list')
+    assert post('calibration', user_name='user2') == (
+        'calibration for user2: no predictions on resolved contracts')
+
+    # Nobody is created by reading, on either side.
+    assert engine.execute('SELECT slack_id FROM "user"').fetchall() == [
+        ('user1',)]
+    assert s.query(app.User).filter(app.User.slack_id == 'user2').count() == 0
+
+def test_statement_timer_after_error(s, monkeypatch):
+    s.execute(app.User.__table__.insert(), dict(slack_id='user1'))
+    with pytest.raises(sqlalchemy.exc.IntegrityError):
+        with s.begin_nested():
+            s.execute(app.User.__table__.insert(), dict(slack_id='user1'))
+
+    # Nothing is left behind on the connection by the failed statement, and
+    # the next one is timed from its own start.
+    assert 'statement_start' not in s.connection().info
+    timings = []
+    monkeypatch.setattr(app.metrics, 'record_statement',
+                        lambda statement, seconds: timings.append(seconds))
+    threading.Event().wait(.05)
+    s.execute('SELECT 1')
+    assert len(timings) == 1 and timings[0] < .05
+
+def test_batch(s):
+    run(s, app.create, 'test-contract1', 'terms', '1 hour', '.5')
+    run(s, app.create, 'test-contract2', 'terms', '1 hour', '.5')
+    run(s, app.create, 'test-contract3', 'terms', '1 hour', '.5')
+    run(s, app.resolve, 'test-contract3', 'true')
+
+    assert run(s, app.batch, 'test-contract1=60%', 'test-contract2=.3') == (
+        'Added predictions for test-contract1 at 60.0%, '
+        'test-contract2 at 30.0%')
+    assert run(s, app.list) == '''\
+test-contract1   60.00% (2 predictions)
+test-contract2   30.00% (2 predictions)'''
+
+    # One bad prediction and none of them go in, even before the request's
+    # transaction is rolled back.
+    user = app.lookup_or_create_user(s, 'test')
+    for args, error in [
+            (['test-contract1=.7', 'test-contract3=.7'],
+             'contract test-contract3 is already resolved'),
+            (['test-contract1=.7', 'test-contract4=.7'],
+             'unknown contract test-contract4'),
+            (['test-contract1=.7', 'test-contract2=2'],
+             'percentage >= 100%: 2'),
+            (['test-contract1=.7', 'test-contract1=.8'],
+             'listed more than once'),
+            (['test-contract1'],
+             'expected <contract-name>=<percentage>, got "test-contract1"'),
+            ([], 'usage is batch <contract-name>=<percentage> ...')]:
+        with pytest.raises(app.PredictionsError) as e:
+            app.batch(s, user, *args)
+        assert error in str(e.value)
+        assert s.query(app.Prediction).count() == 5